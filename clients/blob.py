@@ -0,0 +1,9 @@
+import functools
+import os
+from azure.storage.blob import BlobServiceClient, ContainerClient
+
+@functools.lru_cache(maxsize=None)
+def get_container_client(container_name: str) -> ContainerClient:
+    # built once per process; the underlying HTTP session is reused across invocations
+    blob_service_client = BlobServiceClient.from_connection_string(os.getenv("AzureWebJobsStorage"))
+    return blob_service_client.get_container_client(container_name)
@@ -0,0 +1,132 @@
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+from clients.blob import get_container_client
+
+# each container gets its own subdirectory; its least recently used blobs are evicted past the size cap
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "blob-cache"))
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_MB", 1024)) * 1024 * 1024
+BLOB_DOWNLOAD_CONCURRENCY = int(os.getenv("BLOB_DOWNLOAD_CONCURRENCY", 4))
+
+class BlobDiskCache:
+    """
+    Size-capped local copies of the blobs in one container. A blob name here never changes content
+    once written (lesson videos are named by uuid, renders by a hash of their inputs), so a file
+    named after the digest of the container and blob name is always the blob's content. Downloads stream to a unique temporary
+    file and are renamed into place, threads asking for the same blob share one download, and a
+    file is never evicted while a caller in this process is still reading it.
+    """
+
+    def __init__(self, container_name: str, cache_dir: str = BLOB_CACHE_DIR, max_bytes: int = BLOB_CACHE_MAX_BYTES):
+        self.container_name = container_name
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pins: dict[str, int] = {}
+        self._key_locks: dict[str, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, blob_name: str) -> str:
+        digest = hashlib.sha256(f"{self.container_name}/{blob_name}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    @contextmanager
+    def local_copy(self, blob_name: str) -> Iterator[str]:
+        # path of a local copy of the blob, valid until the block exits; open it read-only
+        path = self._path(blob_name)
+        with self._lock:
+            self._pins[path] = self._pins.get(path, 0) + 1
+            key_lock = self._key_locks.setdefault(path, threading.Lock())
+
+        try:
+            with key_lock:
+                try:
+                    # bump the mtime so eviction sees it as recently used
+                    os.utime(path)
+                    self.hits += 1
+                except FileNotFoundError:
+                    self.misses += 1
+                    self._download(blob_name, path)
+                    self._evict()
+            yield path
+        finally:
+            with self._lock:
+                self._pins[path] -= 1
+                if self._pins[path] == 0:
+                    del self._pins[path]
+                    del self._key_locks[path]
+
+    def put(self, blob_name: str, local_path: str) -> None:
+        # uploads the file and keeps a local copy, so this worker's next read is a hit
+        blob_client = get_container_client(self.container_name).get_blob_client(blob_name)
+        with open(local_path, "rb") as data:
+            blob_client.upload_blob(data, overwrite=True, max_concurrency=BLOB_DOWNLOAD_CONCURRENCY)
+
+        path = self._path(blob_name)
+        temp_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            shutil.copyfile(local_path, temp_path)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._evict()
+
+    def _download(self, blob_name: str, path: str) -> None:
+        temp_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            blob_client = get_container_client(self.container_name).get_blob_client(blob_name)
+            with open(temp_path, "wb") as temp_file:
+                # written chunk by chunk rather than read into memory whole
+                blob_client.download_blob(max_concurrency=BLOB_DOWNLOAD_CONCURRENCY).readinto(temp_file)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".part"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        with self._lock:
+            pinned = set(self._pins)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path in pinned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # another worker process evicted it first
+                pass
+            except OSError as e:
+                logging.warning(f"Could not evict cached blob {path}: " + str(e))
+                continue
+            total -= size
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+@functools.lru_cache(maxsize=None)
+def get_blob_cache(container_name: str) -> BlobDiskCache:
+    return BlobDiskCache(container_name, os.path.join(BLOB_CACHE_DIR, container_name))
@@ -0,0 +1,81 @@
+import atexit
+import logging
+import os
+import threading
+from gremlin_python.driver import client, serializer
+from gremlin_python.driver.protocol import GremlinServerError
+
+GREMLIN_URL = 'wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/'
+GREMLIN_USERNAME = "/dbs/guidestone/colls/knowledge-graph"
+
+class SharedGraphClient:
+    """
+    One Gremlin client per worker process. The underlying websocket pool is opened on first use,
+    sized to the Functions thread count, and rebuilt whenever a submit fails at the transport level.
+    """
+
+    def __init__(self):
+        self._client: client.Client = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> client.Client:
+        pool_size = int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT", 1))
+        return client.Client(GREMLIN_URL, 'g',
+                             username=GREMLIN_USERNAME,
+                             password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
+                             message_serializer=serializer.GraphSONSerializersV2d0(),
+                             pool_size=pool_size)
+
+    def _get(self) -> client.Client:
+        graph_client = self._client
+        if graph_client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._connect()
+                graph_client = self._client
+        return graph_client
+
+    def _discard(self, stale: client.Client) -> None:
+        # only drop the client that failed; another thread may already have reconnected
+        with self._lock:
+            if self._client is not stale:
+                return
+            self._client = None
+        try:
+            stale.close()
+        except Exception as e:
+            logging.warning("Could not close stale gremlin client: " + str(e))
+
+    def submit(self, message: str, bindings: dict = None):
+        graph_client = self._get()
+        try:
+            return graph_client.submit(message, bindings)
+        except GremlinServerError:
+            # the server answered, so the connection itself is fine
+            raise
+        except Exception as e:
+            logging.warning("Gremlin connection failed, reconnecting: " + str(e))
+            self._discard(graph_client)
+            return self._get().submit(message, bindings)
+
+    def healthcheck(self) -> bool:
+        try:
+            self.submit("g.inject(1)").all().result()
+            return True
+        except Exception as e:
+            logging.error("Gremlin health check failed: " + str(e))
+            graph_client = self._client
+            if graph_client is not None:
+                self._discard(graph_client)
+            return False
+
+    def close(self) -> None:
+        graph_client = self._client
+        if graph_client is not None:
+            self._discard(graph_client)
+
+_graph_client = SharedGraphClient()
+atexit.register(_graph_client.close)
+
+def get_graph_client() -> SharedGraphClient:
+    return _graph_client
@@ -0,0 +1,115 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from psycopg2 import pool, OperationalError, InterfaceError
+
+class SharedConnectionPool:
+    """
+    One ThreadedConnectionPool per worker process. ThreadedConnectionPool raises as soon as every
+    connection is checked out, so a semaphore makes callers wait for a free connection instead,
+    and the time they spend waiting is recorded for the healthcheck.
+    """
+
+    def __init__(self):
+        self._pool: pool.ThreadedConnectionPool = None
+        self._slots: threading.BoundedSemaphore = None
+        self._lock = threading.Lock()
+        self._checked_out = 0
+        self._waiters = 0
+        self._checkouts = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+
+    def _get(self) -> pool.ThreadedConnectionPool:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    maxconn = int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT", 1))
+                    self._slots = threading.BoundedSemaphore(maxconn)
+                    self._pool = pool.ThreadedConnectionPool(1, maxconn, os.getenv("POSTGRES_CONN_STRING"))
+        return self._pool
+
+    def getconn(self):
+        postgreSQL_pool = self._get()
+
+        with self._lock:
+            self._waiters += 1
+        started = time.monotonic()
+        self._slots.acquire()
+        waited = time.monotonic() - started
+        with self._lock:
+            self._waiters -= 1
+            self._checked_out += 1
+            self._checkouts += 1
+            self._wait_seconds += waited
+            self._max_wait_seconds = max(self._max_wait_seconds, waited)
+
+        try:
+            conn = postgreSQL_pool.getconn()
+            if conn.closed:
+                # the server dropped this connection while it sat idle in the pool
+                postgreSQL_pool.putconn(conn, close=True)
+                conn = postgreSQL_pool.getconn()
+        except Exception:
+            self._release()
+            raise
+        return conn
+
+    def putconn(self, conn, close: bool = False) -> None:
+        try:
+            self._pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        with self._lock:
+            self._checked_out -= 1
+        self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "checked_out": self._checked_out,
+                "waiters": self._waiters,
+                "checkouts": self._checkouts,
+                "total_wait_seconds": self._wait_seconds,
+                "max_wait_seconds": self._max_wait_seconds,
+            }
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.closeall()
+
+_postgres_pool = SharedConnectionPool()
+atexit.register(_postgres_pool.close)
+
+def get_postgres_pool() -> SharedConnectionPool:
+    return _postgres_pool
+
+@contextmanager
+def db_cursor():
+    """
+    Check out a pooled connection and yield a cursor on it. The transaction is committed when the
+    block exits cleanly and rolled back otherwise; the connection always goes back to the pool.
+    """
+    conn = _postgres_pool.getconn()
+    broken = False
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+        conn.commit()
+    except (OperationalError, InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception as e:
+            logging.warning("Could not roll back postgres transaction: " + str(e))
+            broken = True
+        raise
+    finally:
+        _postgres_pool.putconn(conn, close=broken)
@@ -0,0 +1,11 @@
+import functools
+import os
+from azure.storage.queue import QueueClient, TextBase64EncodePolicy, TextBase64DecodePolicy
+
+@functools.lru_cache(maxsize=None)
+def get_queue_client(queue_name: str) -> QueueClient:
+    # built once per process; Functions queue triggers expect base64-encoded messages
+    return QueueClient.from_connection_string(conn_str=os.environ['AzureWebJobsStorage'],
+                                              queue_name=queue_name,
+                                              message_encode_policy=TextBase64EncodePolicy(),
+                                              message_decode_policy=TextBase64DecodePolicy())
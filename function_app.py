@@ -1,16 +1,22 @@
 from typing import List
 import typing
 import azure.functions as func
-from gremlin_python.driver import client, serializer
-import os
+from clients.gremlin import get_graph_client
 import logging
-from psycopg2 import pool
 import json
+from pydantic import ValidationError
+from clients.postgres import db_cursor, get_postgres_pool
 from grader.grade import score_user
 from grader.metrics import calculate_attention
-from graph.api import get_graph_structure, get_node_details
+from grader.sessions import decode_vision_points, load_vision_points, save_vision_points
+from graph.api import get_node_details
+from graph.cache import bump_graph_version, get_versioned_graph_structure
+from graph.changes import get_graph_changes
 from graph.expand import expand_graph
-from graph.traverse import traverse_graph
+from graph.coalesce import schedule_traversal
+from graph.traverse import parse_node_updated_message
+from lesson.builds import lesson_queue_stats
+from lesson.render import get_render_executor
 from lesson.create import create_lesson
 from users.auth import exchange_token
 from users.new import create_new_user
@@ -23,19 +29,18 @@ app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
            methods=['GET','POST'])
 def healthcheck(req: func.HttpRequest) -> func.HttpResponse:
     # verify gremlin connection
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
+    if not get_graph_client().healthcheck():
+        return func.HttpResponse(
+            status_code=503
+        )
+
     # verify postgres connection
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    postgreSQL_pool.putconn(conn)
-    postgreSQL_pool.closeall()
+    with db_cursor() as cursor:
+        cursor.execute("SELECT 1")
 
     return func.HttpResponse(
-        status_code=200
+        status_code=200,
+        body=json.dumps({"postgres_pool": get_postgres_pool().stats(), "lesson_queue": lesson_queue_stats(), "renders": get_render_executor().stats()})
     )
 
 @app.function_name("createUser")
@@ -70,11 +75,37 @@ def exchangeToken(req: func.HttpRequest) -> func.HttpResponse:
            auth_level=func.AuthLevel.ANONYMOUS, 
            methods=['POST'])
 def getGraphStructure(req: func.HttpRequest) -> func.HttpResponse:
-    graph_structure = get_graph_structure(req.get_json())
+    try:
+        etag, graph_structure = get_versioned_graph_structure(req.get_json(), req.headers.get("If-None-Match"))
+    except ValidationError as e:
+        # e.g. a page_size below 1 or a negative radius
+        return func.HttpResponse(
+            status_code=400,
+            body=str(e)
+        )
+
+    if graph_structure is None:
+        return func.HttpResponse(
+            status_code=304,
+            headers={"ETag": etag}
+        )
 
     return func.HttpResponse(
         status_code=200,
-        body=json.dumps(graph_structure)
+        body=json.dumps(graph_structure),
+        headers={"ETag": etag}
+    )
+
+@app.function_name("getGraphChanges")
+@app.route(route="getGraphChanges",
+           auth_level=func.AuthLevel.ANONYMOUS, 
+           methods=['POST'])
+def getGraphChanges(req: func.HttpRequest) -> func.HttpResponse:
+    graph_changes = get_graph_changes(req.get_json())
+
+    return func.HttpResponse(
+        status_code=200,
+        body=json.dumps(graph_changes)
     )
 
 @app.function_name("getNodeDetails")
@@ -111,7 +142,7 @@ def expandGraph(req: func.HttpRequest, queue: func.Out[str]) -> func.HttpRespons
                   queue_name='node-updated',
                   connection="AzureWebJobsStorage")
 def traverseGraph(queuein: func.QueueMessage, context) -> None:
-    traverse_graph(queuein.get_body().decode("utf-8"))
+    schedule_traversal(parse_node_updated_message(queuein.get_body().decode("utf-8")))
     
 @app.function_name("createLesson")
 @app.queue_trigger(arg_name='queuemessage', 
@@ -128,26 +159,34 @@ def createLesson(queuemessage: func.QueueMessage, context) -> None:
                   queue_name='quiz-taken',
                   connection="AzureWebJobsStorage")
 def lessonDone(req: func.HttpRequest, queue: func.Out[str]) -> func.HttpResponse:
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    cursor = conn.cursor()
+    graph_client = get_graph_client()
 
     req_json = req.get_json()
 
-    attention_score = calculate_attention(req_json['vision_points'], req_json['node_id'])
-    
-    queue.set(json.dumps({"user_id": req_json['user_id'], "node_id": req_json['node_id'], "attention_score": attention_score, "quiz_data": req_json["quiz_data"]}))
+    # attention needs at least two distinct sample times to fit the gaze spline
+    try:
+        times, x_coords, y_coords = decode_vision_points(req_json['vision_points'])
+        usable = len(times) == len(x_coords) == len(y_coords) and len(set(times.tolist())) >= 2
+    except Exception as e:
+        logging.error("Could not parse vision_points: " + str(e))
+        usable = False
+    if not usable:
+        return func.HttpResponse(
+            status_code=400,
+            body="vision_points needs at least two samples at different times"
+        )
+
+    # attention is scored by gradeQuiz; only store the raw gaze samples here
+    session_id = save_vision_points(req_json['user_id'], req_json['node_id'], req_json['vision_points'])
+
+    queue.set(json.dumps({"user_id": req_json['user_id'], "node_id": req_json['node_id'], "session_id": session_id, "quiz_data": req_json["quiz_data"]}))
 
     # mark node status as grading
-    graph_client.submit(f"g.V('{req_json['node_id']}').property('status', 'scoring')")
+    graph_client.submit(f"g.V('{req_json['node_id']}').property('status', 'scoring')").all().result()
+    bump_graph_version(req_json['user_id'], [req_json['node_id']])
 
     return func.HttpResponse(
-        status_code=200
+        status_code=202
     )
 
 @app.function_name("gradeQuiz")
@@ -159,21 +198,27 @@ def lessonDone(req: func.HttpRequest, queue: func.Out[str]) -> func.HttpResponse
                   connection="AzureWebJobsStorage")
 def gradeQuiz(queuein: func.QueueMessage, queueout: func.Out[str], context) -> None:
     req_json = json.loads(queuein.get_body().decode("utf-8"))
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    cursor = conn.cursor()
+    graph_client = get_graph_client()
 
     # get learning statuses and masteries
     tid_callback = graph_client.submit(f"g.V('{req_json['node_id']}').values('table_id')")
     table_id = tid_callback.all().result()[0]
-    cursor.execute("SELECT learning_status, masteries FROM nodes WHERE id=%s", (table_id,))
-    learning_status, masteries = cursor.fetchone()
-
-    score_user(req_json['node_id'], req_json['quiz_data'], req_json['attention_score'], masteries)
-
-    queueout.set(req_json['user_id'])
\ No newline at end of file
+    with db_cursor() as cursor:
+        cursor.execute("SELECT learning_status, masteries FROM nodes WHERE id=%s", (table_id,))
+        learning_status, masteries = cursor.fetchone()
+
+    if "session_id" in req_json:
+        try:
+            attention_score = calculate_attention(load_vision_points(req_json['session_id']), req_json['node_id'])
+        except Exception as e:
+            # grade the quiz without it rather than leave the node scoring forever
+            logging.error("Could not calculate attention: " + str(e))
+            attention_score = None
+    else:
+        # scored by lessonDone before scoring moved here
+        attention_score = req_json['attention_score']
+
+    score_user(req_json['node_id'], req_json['quiz_data'], attention_score, masteries)
+    bump_graph_version(req_json['user_id'], [req_json['node_id']])
+
+    queueout.set(json.dumps({"user_id": req_json['user_id'], "node_id": req_json['node_id']}))
\ No newline at end of file
@@ -4,10 +4,9 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import requests
 from typing import List
-from gremlin_python.driver import client, serializer
-import os
+from clients.gremlin import get_graph_client
 import logging
-from psycopg2 import pool
+from clients.postgres import db_cursor
 from pydantic import BaseModel, Field
 from enum import Enum, auto
 from azure.storage.queue import QueueClient, TextBase64EncodePolicy, TextBase64DecodePolicy
@@ -25,23 +24,16 @@ class AfterLessonReport(BaseModel):
     learning_state: str = Field(description="A summary of the user's learning state. This should include what topics they have mastered, what topics they have struggled with, and what topics they are currently learning. This should be based more heavily on the quiz data. Be sure to include what topics you think the user might have missed, and what topics they might have been confused about.")
 
 def score_user(node_id, quiz_data, attn_score, masteries):
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
+    graph_client = get_graph_client()
     
     gpt_4_llm = AzureChatOpenAI(deployment_name="gpt-4-turbo", api_version="2023-07-01-preview", model_name="gpt-4-1106-preview", temperature=0, max_retries=10)
 
-    
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    cursor = conn.cursor()
-
     # get video
     table_id_callback = graph_client.submit(f"g.V('{node_id}').values('table_id')")
     table_id = table_id_callback.all().result()[0]
-    cursor.execute("SELECT video_id FROM nodes WHERE id = %s", (table_id,))
-    video_id, = cursor.fetchone()
+    with db_cursor() as cursor:
+        cursor.execute("SELECT video_id FROM nodes WHERE id = %s", (table_id,))
+        video_id, = cursor.fetchone()
 
     quiz_data = []
 
@@ -104,7 +96,8 @@ Output your response following this template: {formatting_instructions}
 
     after_lesson_report: AfterLessonReport = grade_chain.invoke({
         "topic_name": video_id,
-        "attention_score": attn_score,
+        # None when the viewing's gaze data couldn't be scored
+        "attention_score": "unknown" if attn_score is None else attn_score,
         "quiz_data_str": quiz_data_str,
         "rewind_per_sec": 0,
         "sec_b4_rewind": 0,
@@ -114,6 +107,6 @@ Output your response following this template: {formatting_instructions}
         "formatting_instructions": dpe_fixing_parser.get_format_instructions()
     })
 
-    graph_client.submit(f"g.V('{node_id}').property('status', 'graded')")
+    graph_client.submit(f"g.V('{node_id}').property('status', 'graded')").all().result()
 
     # cursor.execute("INSERT INTO nodes (node_id, teaching_effectiveness_report, learning_state) VALUES (%s, %s, %s)", (node_id, after_lesson_report.teaching_effectiveness_report, after_lesson_report.learning_state))
\ No newline at end of file
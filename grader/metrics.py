@@ -4,10 +4,10 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import requests
 from typing import List
-from gremlin_python.driver import client, serializer
-import os
+from clients.gremlin import get_graph_client
+from clients.blob_cache import get_blob_cache
 import logging
-from psycopg2 import pool
+from clients.postgres import db_cursor
 from pydantic import BaseModel, Field
 from enum import Enum, auto
 from azure.storage.queue import QueueClient, TextBase64EncodePolicy, TextBase64DecodePolicy
@@ -16,86 +16,39 @@ from langchain.output_parsers import OutputFixingParser, PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from operator import itemgetter
 import re
-from azure.storage.blob import BlobServiceClient
 import json
-from skimage.metrics import structural_similarity as compare_ssim
+from grader.timeline import compute_visual_timeline, load_video_metadata, load_visual_timeline, save_video_metadata, save_visual_timeline, visual_change_at
+from grader.sessions import decode_vision_points
 
 def calculate_attention(points, node_id):
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    cursor = conn.cursor()
+    graph_client = get_graph_client()
 
     # get video
     table_id_callback = graph_client.submit(f"g.V('{node_id}').values('table_id')")
     table_id = table_id_callback.all().result()[0]
-    cursor.execute("SELECT video_id FROM nodes WHERE id = %s", (table_id,))
-    video_id, = cursor.fetchone()
+    with db_cursor() as cursor:
+        cursor.execute("SELECT video_id FROM nodes WHERE id = %s", (table_id,))
+        video_id, = cursor.fetchone()
 
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv("AzureWebJobsStorage"))
-    container_client = blob_service_client.get_container_client("videos")
-    blob_client = container_client.get_blob_client(video_id)
-    stream = blob_client.download_blob()
-    video_bytes = stream.readall()
+    times, gaze = _gaze_spline(points)
+    smooth_times = np.linspace(times[0], times[-1], 100)
 
-    temp_video_path = 'temp_video.mp4'
-    with open(temp_video_path, 'wb') as temp_video_file:
-        temp_video_file.write(video_bytes)
+    # the visual change only depends on the video, so it is measured once and shared by every viewing
+    timeline = _visual_timeline(video_id)
+    return _attention_from_ssim(gaze(smooth_times), visual_change_at(timeline, smooth_times[1:]))
 
+def _gaze_spline(points):
     # smoothen motion
-    times = [point['time'] for point in points]
-    x_coords = [point['x'] for point in points]
-    y_coords = [point['y'] for point in points]
-
-    cs_x = CubicSpline(times, x_coords)
-    cs_y = CubicSpline(times, y_coords)
-
-    smooth_times = np.linspace(min(times), max(times), 100)
-
-    smooth_x = cs_x(smooth_times)
-    smooth_y = cs_y(smooth_times)
-
-    smooth_points = [{"x": x, "y": y, "time": t} for x, y, t in zip(smooth_x, smooth_y, smooth_times)]
-
-    # get the frames
-    frames = []
-    cap = cv2.VideoCapture("temp_video.mp4")
-    fps = cap.get(cv2.CAP_PROP_FPS)  # Get frames per second of the video
-
-    for timestamp in [timestamps['time'] for timestamps in smooth_points]:
-        cap.set(cv2.CAP_PROP_POS_MSEC, timestamp*1000)
-        ret, frame = cap.read()
-        if ret:
-            frames.append(frame)
-        else:
-            print(f"Frame for timestamp {timestamp} not found.")
-
-    cap.release()
-
-    ssim_values = []
-    position_differences = []
-
-    for i in range(len(frames) - 1):
-        frame1 = frames[i]
-        frame2 = frames[i + 1]
-        
-        # Convert frames to grayscale for SSIM calculation
-        gray1 = cv2.cvtColor(frame1, cv2.COLOR_BGR2GRAY)
-        gray2 = cv2.cvtColor(frame2, cv2.COLOR_BGR2GRAY)
-        
-        # Calculate SSIM between two consecutive frames
-        ssim, _ = compare_ssim(gray1, gray2, full=True)
-        ssim_values.append(ssim)
-        
-        # Calculate difference in position between coordinates of two consecutive frames
-        coord1 = (smooth_points[i]['x'], smooth_points[i]['y'])
-        coord2 = (smooth_points[i + 1]['x'], smooth_points[i + 1]['y'])
-        position_diff = np.sqrt((coord2[0] - coord1[0]) ** 2 + (coord2[1] - coord1[1]) ** 2)
-        position_differences.append(position_diff)
+    times, x_coords, y_coords = decode_vision_points(points)
+    # CubicSpline needs strictly increasing times; clients can repeat a timestamp
+    times, first_indices = np.unique(times.astype(np.float64), return_index=True)
+    coords = np.column_stack((x_coords[first_indices], y_coords[first_indices])).astype(np.float64)
+
+    return times, CubicSpline(times, coords)
+
+def _attention_from_ssim(smooth_coords, ssim_values):
+    # distance the gaze moved between consecutive smoothed samples
+    position_differences = np.linalg.norm(np.diff(smooth_coords, axis=0), axis=1)[:len(ssim_values)]
 
     ssim_derivatives = np.diff(ssim_values)
     position_derivatives = np.diff(position_differences)
@@ -105,47 +58,108 @@ def calculate_attention(points, node_id):
 
     return attention_score
 
+def _visual_timeline(video_id):
+    timeline = load_visual_timeline(video_id)
+    if timeline is not None and len(timeline["times"]):
+        return timeline
+
+    # lessons made before timelines were stored: decode the video once and keep the result
+    with get_blob_cache("videos").local_copy(video_id) as video_path:
+        timeline = compute_visual_timeline(video_path)
+    save_visual_timeline(video_id, timeline)
+    return timeline
+
+def _finite_or_none(values):
+    return [float(value) if np.isfinite(value) else None for value in values]
+
+def calculate_cohort_attention(video_id, sessions):
+    """
+    Scores many viewings of one video against a single visual-change signal. sessions maps a session
+    id to its vision points in any form decode_vision_points accepts. Returns each session's attention
+    score, their mean and median, and curves over the video's timeline: the visual change, the mean
+    gaze speed of the sessions watching at that moment, and how many were. A session whose gaze can't
+    be fitted scores None and doesn't count towards the rest.
+    """
+    timeline = _visual_timeline(video_id)
+    grid = timeline["times"].astype(np.float64)
+    scores = {}
+    gaze_speeds = np.full((len(sessions), len(grid)), np.nan)
+
+    for row, (session_id, points) in enumerate(sessions.items()):
+        try:
+            times, gaze = _gaze_spline(points)
+        except Exception as e:
+            # e.g. fewer than two distinct sample times; scored None and left out of the curves
+            logging.error(f"Could not fit gaze for session {session_id}: " + str(e))
+            scores[session_id] = np.nan
+            continue
+        smooth_times = np.linspace(times[0], times[-1], 100)
+        scores[session_id] = _attention_from_ssim(gaze(smooth_times), visual_change_at(timeline, smooth_times[1:]))
+
+        watched = (grid >= times[0]) & (grid <= times[-1])
+        gaze_speeds[row, watched] = np.linalg.norm(gaze(grid[watched], 1), axis=1)
+
+    viewers = np.sum(~np.isnan(gaze_speeds), axis=0)
+    mean_gaze_speed = np.divide(np.nansum(gaze_speeds, axis=0), viewers, out=np.full(len(grid), np.nan), where=viewers > 0)
+    finite_scores = np.array([score for score in scores.values() if np.isfinite(score)])
+
+    return {
+        "scores": {session_id: _finite_or_none([score])[0] for session_id, score in scores.items()},
+        "mean_score": float(np.mean(finite_scores)) if len(finite_scores) else None,
+        "median_score": float(np.median(finite_scores)) if len(finite_scores) else None,
+        "curves": {
+            "times": grid.tolist(),
+            "visual_change": (1 - timeline["ssim"].astype(np.float64)).tolist(),
+            "mean_gaze_speed": _finite_or_none(mean_gaze_speed),
+            "viewers": viewers.tolist(),
+        },
+    }
+
+def _video_metadata(video_id):
+    metadata = load_video_metadata(video_id)
+    if metadata is not None:
+        return metadata
+
+    # lessons made before metadata was stored: read it from the video once and keep it
+    with get_blob_cache("videos").local_copy(video_id) as video_path:
+        cap = cv2.VideoCapture(video_path)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+
+    duration = frame_count / fps
+    save_video_metadata(video_id, duration, fps, [0.0, duration])
+    return load_video_metadata(video_id)
+
 def calculate_pace(rewinds, node_id):
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    cursor = conn.cursor()
+    """
+    Rewind statistics for one viewing of the node's lesson video, computed from the video's stored
+    duration and scene boundaries. Gaps are the distances between consecutive rewinds' 'from'
+    positions in the order they happened; scene_rewind_density is rewinds per second of each scene.
+    """
+    graph_client = get_graph_client()
 
     # get video
     table_id_callback = graph_client.submit(f"g.V('{node_id}').values('table_id')")
     table_id = table_id_callback.all().result()[0]
-    cursor.execute("SELECT video_id FROM nodes WHERE id = %s", (table_id,))
-    video_id, = cursor.fetchone()
-
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv("AzureWebJobsStorage"))
-    container_client = blob_service_client.get_container_client("videos")
-    blob_client = container_client.get_blob_client(video_id)
-    stream = blob_client.download_blob()
-    video_bytes = stream.readall()
-
-    temp_video_path = 'temp_video.mp4'
-    with open(temp_video_path, 'wb') as temp_video_file:
-        temp_video_file.write(video_bytes)
-
-    cap = cv2.VideoCapture(temp_video_path)
-
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    
-    # Get the total number of frames in the video
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    
-    # Calculate the duration of the video in seconds
-    duration_seconds = frame_count / fps
-
-    rewinds_per_second = len(rewinds) / duration_seconds
-
-    secs_between_rewinds = [rewinds[i+1]['from'] - rewinds[i]['from'] for i in range(len(rewinds)-1)]
-    # Calculate the average of these differences
-    average_secs_between_rewinds = sum(secs_between_rewinds) / len(secs_between_rewinds)
-
-    return rewinds_per_second, average_secs_between_rewinds
-
+    with db_cursor() as cursor:
+        cursor.execute("SELECT video_id FROM nodes WHERE id = %s", (table_id,))
+        video_id, = cursor.fetchone()
+
+    metadata = _video_metadata(video_id)
+    scene_boundaries = metadata["scene_boundaries"]
+
+    rewind_positions = np.array([rewind['from'] for rewind in rewinds], dtype=np.float64)
+    secs_between_rewinds = np.diff(rewind_positions)
+
+    scene_rewinds, _ = np.histogram(np.clip(rewind_positions, 0, scene_boundaries[-1]), bins=scene_boundaries)
+    scene_durations = np.diff(scene_boundaries)
+
+    has_gaps = len(secs_between_rewinds) > 0
+    return {
+        "rewinds_per_second": len(rewind_positions) / metadata["duration"],
+        "mean_secs_between_rewinds": float(np.mean(secs_between_rewinds)) if has_gaps else None,
+        "median_secs_between_rewinds": float(np.median(secs_between_rewinds)) if has_gaps else None,
+        "p90_secs_between_rewinds": float(np.percentile(secs_between_rewinds, 90)) if has_gaps else None,
+        "scene_rewind_density": np.divide(scene_rewinds, scene_durations, out=np.zeros(len(scene_durations)), where=scene_durations > 0).tolist(),
+    }
@@ -0,0 +1,37 @@
+import base64
+import numpy as np
+from clients.postgres import db_cursor
+
+# little-endian float32, the layout clients pack the compact upload columns in
+VISION_DTYPE = np.dtype("<f4")
+
+def decode_vision_points(vision_points) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the (time, x, y) columns of a viewing's gaze samples. Accepts the original list of
+    {x, y, time} dicts or the compact form {"time": ..., "x": ..., "y": ...}, where each column is
+    base64-encoded little-endian float32 and is read straight into an array without a copy.
+    """
+    if isinstance(vision_points, tuple):
+        return vision_points
+    if isinstance(vision_points, dict):
+        return tuple(np.frombuffer(base64.b64decode(vision_points[column]), dtype=VISION_DTYPE) for column in ("time", "x", "y"))
+    return tuple(np.array([point[column] for point in vision_points], dtype=VISION_DTYPE) for column in ("time", "x", "y"))
+
+def save_vision_points(user_id: str, node_id: str, vision_points) -> int:
+    # raw gaze samples from one viewing, kept until the quiz-taken worker scores them
+    columns = np.stack(decode_vision_points(vision_points)).astype(VISION_DTYPE, copy=False)
+    with db_cursor() as cursor:
+        cursor.execute("INSERT INTO lesson_sessions (user_id, node_id, vision_columns) VALUES (%s, %s, %s) RETURNING id",
+                       (str(user_id), node_id, columns.tobytes()))
+        session_id, = cursor.fetchone()
+    return session_id
+
+def load_vision_points(session_id: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    with db_cursor() as cursor:
+        cursor.execute("SELECT vision_columns, vision_points FROM lesson_sessions WHERE id = %s", (session_id,))
+        vision_columns, vision_points = cursor.fetchone()
+    if vision_columns is None:
+        return decode_vision_points(vision_points)
+
+    time, x, y = np.frombuffer(vision_columns, dtype=VISION_DTYPE).reshape(3, -1)
+    return time, x, y
@@ -0,0 +1,54 @@
+import os
+from typing import Iterable, Iterator
+import numpy as np
+from scipy.ndimage import uniform_filter
+
+# same constants as skimage's structural_similarity defaults
+SSIM_WINDOW = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+# frames stacked per kernel call; bounds memory at roughly 10 float64 copies of a batch
+SSIM_BATCH_SIZE = int(os.getenv("SSIM_BATCH_SIZE", 32))
+
+def consecutive_ssim(frames: np.ndarray, data_range: float = 255) -> np.ndarray:
+    """
+    Mean SSIM between every consecutive pair of an (N, H, W) stack of grayscale frames, N-1 values in
+    all. Matches skimage's structural_similarity with its defaults (7x7 uniform window, sample
+    covariance, border cropped before averaging) without building the SSIM maps pair by pair: each
+    frame's local mean and variance are filtered once and shared by both pairs it belongs to.
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    if len(frames) < 2:
+        return np.empty(0)
+
+    size = (1, SSIM_WINDOW, SSIM_WINDOW)
+    cov_norm = SSIM_WINDOW ** 2 / (SSIM_WINDOW ** 2 - 1)
+    c1 = (SSIM_K1 * data_range) ** 2
+    c2 = (SSIM_K2 * data_range) ** 2
+
+    mu = uniform_filter(frames, size=size)
+    var = cov_norm * (uniform_filter(frames * frames, size=size) - mu * mu)
+    mu_x, mu_y = mu[:-1], mu[1:]
+    covar = cov_norm * (uniform_filter(frames[:-1] * frames[1:], size=size) - mu_x * mu_y)
+
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * covar + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (var[:-1] + var[1:] + c2))
+
+    pad = (SSIM_WINDOW - 1) // 2
+    return ssim_map[:, pad:-pad, pad:-pad].mean(axis=(1, 2))
+
+def overlapping_batches(samples: Iterable[tuple[float, np.ndarray]], batch_size: int = SSIM_BATCH_SIZE) -> Iterator[tuple[list[float], np.ndarray]]:
+    """
+    Groups (timestamp, frame) samples into stacks of up to batch_size frames. Each stack after the
+    first starts with the last frame of the one before, so running consecutive_ssim on every stack
+    covers every consecutive pair exactly once.
+    """
+    times, frames = [], []
+    for timestamp, frame in samples:
+        times.append(timestamp)
+        frames.append(frame)
+        if len(frames) == batch_size:
+            yield times, np.stack(frames)
+            times, frames = times[-1:], frames[-1:]
+    if len(frames) > 1:
+        yield times, np.stack(frames)
@@ -0,0 +1,115 @@
+import io
+import os
+from typing import Iterator
+import cv2
+import numpy as np
+from clients.postgres import db_cursor
+from grader.ssim import consecutive_ssim, overlapping_batches
+
+# samples per second of video in the stored timeline
+TIMELINE_SAMPLE_RATE = float(os.getenv("TIMELINE_SAMPLE_RATE", 4))
+# analysis resolution: frames are compared at this width (aspect ratio kept); SSIM barely changes below full resolution
+TIMELINE_FRAME_WIDTH = int(os.getenv("TIMELINE_FRAME_WIDTH", 256))
+
+def _to_analysis_frame(frame: np.ndarray) -> np.ndarray:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape
+    if width <= TIMELINE_FRAME_WIDTH:
+        return gray
+    return cv2.resize(gray, (TIMELINE_FRAME_WIDTH, round(height * TIMELINE_FRAME_WIDTH / width)), interpolation=cv2.INTER_AREA)
+
+def sample_frames(video_path: str, timestamps) -> Iterator[tuple[float, np.ndarray]]:
+    """
+    Yields (timestamp, analysis frame) for each timestamp in ascending order. The video is decoded
+    once, front to back: frames in between are only grabbed, and just the sampled ones are converted
+    out of the decoder. Timestamps past the end of the video are dropped.
+    """
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_index = -1
+    current = None
+    try:
+        for timestamp in sorted(timestamps):
+            target = max(0, round(timestamp * fps))
+            while frame_index < target:
+                if not cap.grab():
+                    return
+                frame_index += 1
+                current = None
+            # timestamps closer together than a frame share it
+            if current is None:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    return
+                current = _to_analysis_frame(frame)
+            yield timestamp, current
+    finally:
+        cap.release()
+
+def compute_visual_timeline(video_path: str) -> dict[str, np.ndarray]:
+    """
+    Decodes the video once, front to back, and returns the frame-to-frame visual change sampled at
+    TIMELINE_SAMPLE_RATE: times[i] is when sample i+1 was taken, ssim[i] the SSIM between samples i
+    and i+1 and motion[i] their mean absolute pixel difference.
+    """
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    step = max(1, round(fps / TIMELINE_SAMPLE_RATE))
+
+    times, ssim_values, motion_values = [], [], []
+    for batch_times, frames in overlapping_batches(sample_frames(video_path, np.arange(0, frame_count, step) / fps)):
+        times.extend(batch_times[1:])
+        ssim_values.extend(consecutive_ssim(frames))
+        motion_values.extend(np.abs(np.diff(frames.astype(np.int16), axis=0)).mean(axis=(1, 2)) / 255)
+
+    return {
+        "times": np.asarray(times, dtype=np.float32),
+        "ssim": np.asarray(ssim_values, dtype=np.float32),
+        "motion": np.asarray(motion_values, dtype=np.float32),
+    }
+
+def save_visual_timeline(video_id: str, timeline: dict[str, np.ndarray]) -> None:
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **timeline)
+
+    with db_cursor() as cursor:
+        cursor.execute("""
+        INSERT INTO video_timelines (video_id, timeline) VALUES (%s, %s)
+        ON CONFLICT (video_id) DO UPDATE SET timeline = EXCLUDED.timeline, created_at = now()
+        """, (video_id, buffer.getvalue()))
+
+def load_visual_timeline(video_id: str) -> dict[str, np.ndarray]:
+    # None for videos made before timelines were stored
+    with db_cursor() as cursor:
+        cursor.execute("SELECT timeline FROM video_timelines WHERE video_id = %s", (video_id,))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+
+    with np.load(io.BytesIO(bytes(row[0]))) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+def save_video_metadata(video_id: str, duration: float, fps: float, scene_boundaries: list[float]) -> None:
+    # scene_boundaries are the scene edges in seconds, from 0 to duration
+    with db_cursor() as cursor:
+        cursor.execute("""
+        INSERT INTO video_metadata (video_id, duration, fps, scene_boundaries) VALUES (%s, %s, %s, %s)
+        ON CONFLICT (video_id) DO UPDATE SET duration = EXCLUDED.duration, fps = EXCLUDED.fps, scene_boundaries = EXCLUDED.scene_boundaries
+        """, (video_id, float(duration), float(fps), [float(boundary) for boundary in scene_boundaries]))
+
+def load_video_metadata(video_id: str) -> dict[str, any]:
+    # None for videos made before metadata was stored
+    with db_cursor() as cursor:
+        cursor.execute("SELECT duration, fps, scene_boundaries FROM video_metadata WHERE video_id = %s", (video_id,))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+
+    duration, fps, scene_boundaries = row
+    return {"duration": duration, "fps": fps, "scene_boundaries": np.asarray(scene_boundaries, dtype=np.float64)}
+
+def visual_change_at(timeline: dict[str, np.ndarray], times: np.ndarray) -> np.ndarray:
+    # SSIM at arbitrary timestamps, linearly interpolated from the stored samples
+    return np.interp(times, timeline["times"], timeline["ssim"])
@@ -1,12 +1,20 @@
-from gremlin_python.driver import client, serializer
+from clients.gremlin import get_graph_client
 import os
 import logging
-from psycopg2 import pool
-from pydantic import BaseModel
-from azure.storage.blob import BlobServiceClient
+from clients.postgres import db_cursor
+from pydantic import BaseModel, Field
+from clients.blob import get_container_client
+from graph.lru import LRUCache
 
 class GraphStructureRequest(BaseModel):
     user_id: int
+    focus_node_id: str = None
+    radius: int = Field(2, ge=0)
+    cursor: str = None
+    page_size: int = Field(None, ge=1)
+
+    def is_full_graph(self) -> bool:
+        return self.focus_node_id is None and self.page_size is None
 
 class NodeDetailRequest(BaseModel):
     node_id: str
@@ -14,43 +22,75 @@ class NodeDetailRequest(BaseModel):
 class GraphError(Exception):
     pass
 
-def get_graph_structure(req_json: dict) -> dict[str, any]:
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    cursor = conn.cursor()
+# vertex id -> nodes table id, filled in whenever a graph is loaded
+_node_table_ids = LRUCache(int(os.getenv("NODE_TABLE_ID_CACHE_SIZE", 100000)))
+
+def project_vertices(vertex_traversal: str) -> list[dict]:
+    # project each vertex selected by the traversal into its id, table id, status and out-neighbour ids
+    graph_client = get_graph_client()
+    callback = graph_client.submit(f"{vertex_traversal}.project('id', 'table_id', 'status', 'out').by('id').by('table_id').by('status').by(out().values('id').fold())")
+    return callback.all().result()
 
+def get_public_names(table_ids: list[str]) -> dict[str, str]:
+    if not table_ids:
+        return {}
+
+    with db_cursor() as cursor:
+        cursor.execute("SELECT id, public_name FROM nodes WHERE id = ANY(%s::int[])", (list(table_ids),))
+        return {str(table_id): public_name for table_id, public_name in cursor.fetchall()}
+
+def get_graph_structure(req_json: dict) -> dict[str, any]:
     try:
         get_graph_body = GraphStructureRequest(**req_json)
     except Exception as e:
         logging.error("Could not parse get graph structure request: " + str(e))
 
-    node_id_callback = graph_client.submit(f"g.V().has('user_id', '{get_graph_body.user_id}').values('id', 'table_id').fold()")
-    node_table_ids = node_id_callback.all().result()[0]
+    user_id = get_graph_body.user_id
+    if get_graph_body.focus_node_id is None:
+        vertex_traversal = f"g.V().has('user_id', '{user_id}')"
+    else:
+        # only the vertices within radius hops of the focus node, in either direction
+        vertex_traversal = f"g.V('{get_graph_body.focus_node_id}').has('user_id', '{user_id}').emit().repeat(both().has('user_id', '{user_id}')).times({get_graph_body.radius}).dedup()"
+
+    if get_graph_body.page_size is not None:
+        # keyset pagination on vertex id; one extra vertex tells us whether there is another page
+        if get_graph_body.cursor is not None:
+            vertex_traversal += f".has('id', gt('{get_graph_body.cursor}'))"
+        vertex_traversal += f".order().by('id').limit({get_graph_body.page_size + 1})"
+
+    # every vertex with its out-neighbours in one traversal instead of one outE() query per vertex
+    vertices = project_vertices(vertex_traversal)
 
     # base_ids_callback = graph_client.submit(f"g.V().hasLabel('start_node').has('user_id', '{get_graph_body.user_id}').out().values('id').fold()")
     # base_ids = base_ids_callback.all().result()[0]
 
-    edges = []
-    nodes = []
-    node_names = {}
-    for node_id, table_id in zip(node_table_ids[::2], node_table_ids[1::2]):
-        # building a list of just node ids
-        nodes.append(node_id)
+    next_cursor = None
+    if get_graph_body.page_size is not None and len(vertices) > get_graph_body.page_size:
+        vertices = vertices[:get_graph_body.page_size]
+        next_cursor = vertices[-1]['id']
+
+    graph_structure = build_graph_payload(vertices)
+
+    if get_graph_body.focus_node_id is not None and get_graph_body.page_size is None:
+        # keep the neighbourhood closed: drop edges leading out of it
+        visible = set(graph_structure["nodes"])
+        graph_structure["edges"] = [edge for edge in graph_structure["edges"] if edge[1] in visible]
 
-        # building a list of edges
-        edge_callback = graph_client.submit(f"g.V('{node_id}').outE().inV().values('id').fold()")
-        edge_results = edge_callback.all().result()[0]
-        edges.extend([(node_id, edge) for edge in edge_results])
+    if get_graph_body.page_size is not None:
+        graph_structure["next_cursor"] = next_cursor
 
-        # building a dictionary of names
-        cursor.execute("SELECT public_name FROM nodes WHERE id = %s", (table_id,))
-        public_name, = cursor.fetchone()
-        node_names[node_id] = public_name
+    return graph_structure
+
+def build_graph_payload(vertices: list[dict]) -> dict[str, any]:
+    # all the names in one query instead of one SELECT per vertex
+    public_names = get_public_names([vertex['table_id'] for vertex in vertices])
+
+    for vertex in vertices:
+        _node_table_ids.put(vertex['id'], vertex['table_id'])
+
+    nodes = [vertex['id'] for vertex in vertices]
+    edges = [(vertex['id'], child_id) for vertex in vertices for child_id in vertex['out']]
+    node_names = {vertex['id']: public_names.get(vertex['table_id']) for vertex in vertices}
 
     return {
         "nodes": nodes,
@@ -59,44 +99,57 @@ def get_graph_structure(req_json: dict) -> dict[str, any]:
         "names": node_names
     }
 
+def _get_node_row(table_id: str, lesson_id: str) -> tuple:
+    # node info and its lesson in one round trip; without a lesson id, join the node's latest lesson
+    with db_cursor() as cursor:
+        cursor.execute("""
+        SELECT n.public_name, n.learning_status, n.masteries, n.blurb, l.id, l.lesson_description, l.video_id, l.quiz
+        FROM nodes n
+        LEFT JOIN lessons l ON l.id = COALESCE(%s, n.lesson_ids[array_upper(n.lesson_ids, 1)])
+        WHERE n.id = %s
+        """, (lesson_id, table_id))
+        return cursor.fetchone()
+
 def get_node_details(req_json: dict) -> dict[str, any]:
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    cursor = conn.cursor()
+    graph_client = get_graph_client()
 
     try:
         node_details_body = NodeDetailRequest(**req_json)
     except Exception as e:
         logging.error("Could not parse node details request: " + str(e))
 
-    node_details_callback = graph_client.submit(f"g.V('{node_details_body.node_id}').valueMap()")
+    node_id = node_details_body.node_id
+    # the gremlin query runs on the shared client's event loop while postgres is queried below
+    node_details_callback = graph_client.submit(f"g.V('{node_id}').valueMap()")
+
+    # a vertex's table id never changes, so when we have already seen it the join needn't wait on gremlin
+    table_id = _node_table_ids.get(node_id)
+    if table_id is not None:
+        node_row = _get_node_row(table_id, None)
+
     node_details_results = node_details_callback.all().result()[0]
 
     logging.info(node_details_results)
 
-    # get the lesson info
-    if node_details_results['lesson_id'][0] != '-1':
-        cursor.execute("SELECT lesson_description, video_id, quiz FROM lessons WHERE id = %s", (node_details_results['lesson_id'][0],))
-        lesson_description, video_id, quiz = cursor.fetchone()
-    else:
-        lesson_description, video_id, quiz = None, None, None
+    lesson_id = node_details_results['lesson_id'][0]
+    lesson_id = None if lesson_id == '-1' else lesson_id
 
-    # get node info 
-    cursor.execute("SELECT public_name, learning_status, masteries, blurb FROM nodes WHERE id = %s", (node_details_results['table_id'][0],))
-    public_name, learning_status, masteries, blurb = cursor.fetchone()
+    if table_id is None:
+        table_id = node_details_results['table_id'][0]
+        _node_table_ids.put(node_id, table_id)
+        node_row = _get_node_row(table_id, lesson_id)
+    elif lesson_id is not None and str(node_row[4]) != lesson_id:
+        # nodes.lesson_ids hasn't caught up with the lesson the graph points at yet
+        node_row = _get_node_row(table_id, lesson_id)
+
+    public_name, learning_status, masteries, blurb, _, lesson_description, video_id, quiz = node_row
+    if lesson_id is None:
+        lesson_description, video_id, quiz = None, None, None
 
     if video_id is None:
         video_url = None
     else:
-        blob_service_client = BlobServiceClient.from_connection_string(os.getenv("AzureWebJobsStorage"))
-        container_client = blob_service_client.get_container_client("videos")
-        blob_client = container_client.get_blob_client(video_id)
-        video_url = blob_client.url
+        video_url = get_container_client("videos").get_blob_client(video_id).url
 
     if not quiz is None:
         quiz = {question: (quiz[question]['choices'], quiz[question]['correct_index']) for question in quiz.keys()}
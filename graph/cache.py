@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import os
+from clients.postgres import db_cursor
+from graph.api import GraphStructureRequest, get_graph_structure
+from graph.lru import LRUCache
+
+# (user_id, view) -> (version, structure)
+_local_structures = LRUCache(int(os.getenv("GRAPH_CACHE_SIZE", 1024)))
+
+# how many versions of node changes to keep per user for delta syncs
+GRAPH_CHANGE_LOG_LENGTH = int(os.getenv("GRAPH_CHANGE_LOG_LENGTH", 200))
+
+def _shared_tier_enabled() -> bool:
+    return os.getenv("GRAPH_CACHE_SHARED", "false").lower() == "true"
+
+def get_graph_version(user_id) -> int:
+    with db_cursor() as cursor:
+        cursor.execute("SELECT version FROM graph_versions WHERE user_id = %s", (str(user_id),))
+        row = cursor.fetchone()
+    return 0 if row is None else row[0]
+
+def bump_graph_version(user_id, node_ids: list[str]) -> int:
+    # call after every write that changes a vertex, its out-edges or its status, with the ids of those vertices
+    user_id = str(user_id)
+    with db_cursor() as cursor:
+        cursor.execute("""
+        INSERT INTO graph_versions (user_id, version, log_floor) VALUES (%s, 1, 0)
+        ON CONFLICT (user_id) DO UPDATE SET
+            version = graph_versions.version + 1,
+            log_floor = GREATEST(COALESCE(graph_versions.log_floor, graph_versions.version), graph_versions.version + 1 - %s)
+        RETURNING version, log_floor;
+        """, (user_id, GRAPH_CHANGE_LOG_LENGTH))
+        version, log_floor = cursor.fetchone()
+
+        cursor.execute("DELETE FROM graph_changes WHERE user_id = %s AND version <= %s", (user_id, log_floor))
+        cursor.executemany("INSERT INTO graph_changes (user_id, version, node_id) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
+                           [(user_id, version, node_id) for node_id in set(node_ids)])
+    return version
+
+def get_changed_nodes(user_id, since_version: int, until_version: int) -> list[str]:
+    """
+    Ids of the vertices changed after since_version up to and including until_version, or None when
+    the change log no longer reaches back to since_version and the caller has to resync in full.
+    """
+    user_id = str(user_id)
+    with db_cursor() as cursor:
+        cursor.execute("SELECT log_floor FROM graph_versions WHERE user_id = %s", (user_id,))
+        row = cursor.fetchone()
+        if row is None or row[0] is None or since_version < row[0]:
+            return None
+
+        cursor.execute("SELECT DISTINCT node_id FROM graph_changes WHERE user_id = %s AND version > %s AND version <= %s",
+                       (user_id, since_version, until_version))
+        return [node_id for node_id, in cursor.fetchall()]
+
+def graph_etag(user_id, version: int, view: str = "") -> str:
+    if view:
+        return f'"{user_id}-{version}-{view}"'
+    return f'"{user_id}-{version}"'
+
+def _view_key(get_graph_body: GraphStructureRequest) -> str:
+    # short digest of the focus/pagination parameters; empty for the full graph
+    if get_graph_body.is_full_graph():
+        return ""
+    params = [get_graph_body.focus_node_id, get_graph_body.radius, get_graph_body.cursor, get_graph_body.page_size]
+    return hashlib.sha1(json.dumps(params).encode("utf-8")).hexdigest()[:12]
+
+def _get_shared_structure(user_id: str, version: int) -> dict:
+    with db_cursor() as cursor:
+        cursor.execute("SELECT structure FROM graph_structure_cache WHERE user_id = %s AND version = %s", (user_id, version))
+        row = cursor.fetchone()
+    return None if row is None else row[0]
+
+def _put_shared_structure(user_id: str, version: int, structure: dict) -> None:
+    with db_cursor() as cursor:
+        cursor.execute("""
+        INSERT INTO graph_structure_cache (user_id, version, structure) VALUES (%s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET version = EXCLUDED.version, structure = EXCLUDED.structure
+        WHERE graph_structure_cache.version < EXCLUDED.version;
+        """, (user_id, version, json.dumps(structure)))
+
+def get_versioned_graph_structure(req_json: dict, if_none_match: str = None) -> tuple[str, dict]:
+    """
+    Returns the ETag for the user's current graph version and the graph structure, or None in place
+    of the structure when if_none_match already names the current version.
+    """
+    try:
+        get_graph_body = GraphStructureRequest(**req_json)
+    except Exception as e:
+        logging.error("Could not parse get graph structure request: " + str(e))
+        raise
+
+    user_id = str(get_graph_body.user_id)
+    view = _view_key(get_graph_body)
+    # the shared tier only holds each user's full graph
+    use_shared_tier = _shared_tier_enabled() and not view
+
+    # read the version before the graph so a concurrent write can only make the cached copy newer than its tag
+    version = get_graph_version(user_id)
+    etag = graph_etag(user_id, version, view)
+    if if_none_match == etag:
+        return etag, None
+
+    cached = _local_structures.get((user_id, view))
+    if cached is not None and cached[0] == version:
+        return etag, cached[1]
+
+    structure = None
+    if use_shared_tier:
+        structure = _get_shared_structure(user_id, version)
+
+    if structure is None:
+        structure = get_graph_structure(req_json)
+        if use_shared_tier:
+            _put_shared_structure(user_id, version, structure)
+
+    _local_structures.put((user_id, view), (version, structure))
+    return etag, structure
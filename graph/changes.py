@@ -0,0 +1,42 @@
+import logging
+from pydantic import BaseModel
+from graph.api import build_graph_payload, project_vertices
+from graph.cache import get_changed_nodes, get_graph_version
+
+class GraphChangesRequest(BaseModel):
+    user_id: int
+    since_version: int
+
+def get_graph_changes(req_json: dict) -> dict[str, any]:
+    """
+    Returns the vertices changed since the client's last-seen graph version, with their out-edges,
+    names and statuses. Falls back to the whole graph (with "full" set) when the change log no longer
+    reaches back that far.
+    """
+    try:
+        get_changes_body = GraphChangesRequest(**req_json)
+    except Exception as e:
+        logging.error("Could not parse get graph changes request: " + str(e))
+
+    user_id = get_changes_body.user_id
+    version = get_graph_version(user_id)
+
+    if get_changes_body.since_version >= version:
+        changed_ids = []
+    else:
+        changed_ids = get_changed_nodes(user_id, get_changes_body.since_version, version)
+
+    if changed_ids is None:
+        vertices = project_vertices(f"g.V().has('user_id', '{user_id}')")
+    elif changed_ids:
+        vertex_ids = ", ".join(f"'{node_id}'" for node_id in changed_ids)
+        vertices = project_vertices(f"g.V({vertex_ids})")
+    else:
+        vertices = []
+
+    changes = build_graph_payload(vertices)
+    changes["statuses"] = {vertex['id']: vertex['status'] for vertex in vertices}
+    changes["version"] = version
+    changes["full"] = changed_ids is None
+
+    return changes
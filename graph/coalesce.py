@@ -0,0 +1,134 @@
+import logging
+import os
+import time
+import uuid
+from clients.postgres import db_cursor
+from graph.traverse import NodeUpdatedMessage, traverse_graph
+
+# node-updated messages for one user arriving within this many seconds of each other share a traversal
+TRAVERSAL_DEBOUNCE_SECONDS = float(os.getenv("TRAVERSAL_DEBOUNCE_SECONDS", 2))
+# a steady stream of messages delays the traversal by at most this long
+TRAVERSAL_MAX_DEBOUNCE_SECONDS = float(os.getenv("TRAVERSAL_MAX_DEBOUNCE_SECONDS", 30))
+# a worker that dies mid-traversal stops blocking the user's graph after this long
+TRAVERSAL_LEASE_SECONDS = int(os.getenv("TRAVERSAL_LEASE_SECONDS", 300))
+
+def _add_request(message: NodeUpdatedMessage) -> None:
+    pending_nodes = [] if message.node_id is None else [message.node_id]
+    with db_cursor() as cursor:
+        cursor.execute("""
+        INSERT INTO traversal_requests (user_id, pending_nodes, full_traversal, last_requested_at)
+        VALUES (%s, %s, %s, now())
+        ON CONFLICT (user_id) DO UPDATE SET
+            pending_nodes = ARRAY(SELECT DISTINCT unnest(traversal_requests.pending_nodes || EXCLUDED.pending_nodes)),
+            full_traversal = traversal_requests.full_traversal OR EXCLUDED.full_traversal,
+            last_requested_at = now();
+        """, (message.user_id, pending_nodes, message.node_id is None))
+
+def _acquire_lease(user_id: str, owner: str) -> bool:
+    with db_cursor() as cursor:
+        cursor.execute("""
+        UPDATE traversal_requests SET lease_owner = %s, lease_expires_at = now() + make_interval(secs => %s)
+        WHERE user_id = %s AND (lease_expires_at IS NULL OR lease_expires_at < now())
+        RETURNING user_id;
+        """, (owner, TRAVERSAL_LEASE_SECONDS, user_id))
+        return cursor.fetchone() is not None
+
+def _wait_for_quiet(user_id: str, owner: str) -> bool:
+    """
+    Debounce: holds off until no new request has arrived for a full window, or until
+    TRAVERSAL_MAX_DEBOUNCE_SECONDS have passed. The lease is renewed on every check so a long wait
+    can't let it expire. Returns False if the lease was lost.
+    """
+    started = time.monotonic()
+    while True:
+        with db_cursor() as cursor:
+            cursor.execute("""
+            UPDATE traversal_requests SET lease_expires_at = now() + make_interval(secs => %s)
+            WHERE user_id = %s AND lease_owner = %s
+            RETURNING EXTRACT(EPOCH FROM (last_requested_at - now())) + %s;
+            """, (TRAVERSAL_LEASE_SECONDS, user_id, owner, TRAVERSAL_DEBOUNCE_SECONDS))
+            row = cursor.fetchone()
+        if row is None:
+            return False
+
+        remaining = min(float(row[0]), TRAVERSAL_MAX_DEBOUNCE_SECONDS - (time.monotonic() - started))
+        if remaining <= 0:
+            return True
+        time.sleep(min(remaining, TRAVERSAL_DEBOUNCE_SECONDS))
+
+def _take_pending(user_id: str, owner: str) -> tuple[list[str], bool]:
+    """
+    Atomically moves the merged requests in flight and renews the lease; None if the lease was lost.
+    Requests stay in flight until _finish_inflight, so anything a dead holder took is merged in here.
+    """
+    with db_cursor() as cursor:
+        cursor.execute("""
+        UPDATE traversal_requests SET
+            inflight_nodes = ARRAY(SELECT DISTINCT unnest(inflight_nodes || pending_nodes)),
+            inflight_full = inflight_full OR full_traversal,
+            pending_nodes = '{}', full_traversal = FALSE,
+            lease_expires_at = now() + make_interval(secs => %s)
+        WHERE user_id = %s AND lease_owner = %s
+        RETURNING inflight_nodes, inflight_full;
+        """, (TRAVERSAL_LEASE_SECONDS, user_id, owner))
+        row = cursor.fetchone()
+    return row
+
+def _finish_inflight(user_id: str, owner: str) -> None:
+    # only once the traversal has succeeded; does nothing if the lease (and the requests) moved on
+    with db_cursor() as cursor:
+        cursor.execute("""
+        UPDATE traversal_requests SET inflight_nodes = '{}', inflight_full = FALSE
+        WHERE user_id = %s AND lease_owner = %s;
+        """, (user_id, owner))
+
+def _release_lease(user_id: str, owner: str) -> bool:
+    # only succeeds when nothing new arrived since the last hand-off; otherwise the holder goes round again
+    with db_cursor() as cursor:
+        cursor.execute("""
+        UPDATE traversal_requests SET lease_owner = NULL, lease_expires_at = NULL
+        WHERE user_id = %s AND lease_owner = %s AND pending_nodes = '{}' AND NOT full_traversal
+          AND inflight_nodes = '{}' AND NOT inflight_full
+        RETURNING user_id;
+        """, (user_id, owner))
+        return cursor.fetchone() is not None
+
+def _drop_lease(user_id: str, owner: str) -> None:
+    # after a failed traversal; the requests stay in flight for whoever takes the lease next
+    with db_cursor() as cursor:
+        cursor.execute("UPDATE traversal_requests SET lease_owner = NULL, lease_expires_at = NULL WHERE user_id = %s AND lease_owner = %s",
+                       (user_id, owner))
+
+def schedule_traversal(message: NodeUpdatedMessage) -> None:
+    """
+    Records the node-updated message and runs the traversal only if no other worker holds the user's
+    lease. The lease holder waits out the debounce window and then traverses from every node that
+    was updated in the meantime, so a burst of messages costs one traversal. Requests taken by a
+    holder that died or failed are traversed by the next one.
+    """
+    _add_request(message)
+
+    owner = str(uuid.uuid4())
+    if not _acquire_lease(message.user_id, owner):
+        logging.info(f"Traversal for user {message.user_id} already running; merged into it")
+        return
+
+    while True:
+        taken = _take_pending(message.user_id, owner) if _wait_for_quiet(message.user_id, owner) else None
+        if taken is None:
+            logging.warning(f"Traversal lease for user {message.user_id} expired; leaving the rest to its new holder")
+            return
+        pending_nodes, full_traversal = taken
+
+        if not pending_nodes and not full_traversal:
+            if _release_lease(message.user_id, owner):
+                return
+            continue
+
+        try:
+            traverse_graph(message.user_id, None if full_traversal else pending_nodes)
+        except Exception:
+            # the retried message takes the lease again and picks the requests up from in flight
+            _drop_lease(message.user_id, owner)
+            raise
+        _finish_inflight(message.user_id, owner)
@@ -1,8 +1,7 @@
 from typing import List
-from gremlin_python.driver import client, serializer
-import os
+from clients.gremlin import get_graph_client
 import logging
-from psycopg2 import pool
+from clients.postgres import db_cursor
 from pydantic import BaseModel, Field
 from enum import Enum
 from langchain_openai import AzureChatOpenAI
@@ -12,6 +11,7 @@ from operator import itemgetter
 import re
 import json
 from stemtopics import Topics
+from graph.cache import bump_graph_version
 
 def clean_text(text: str) -> str:
     if text is None:
@@ -35,14 +35,7 @@ class Masteries(BaseModel):
     masteries: list[str] = Field(description="The list of all the sub-topics you have to learn as part of mastering this topic. These are NOT prerequisites, they are part of learning the topic at hand. For example, when learning limits, you have to learn one sided limits, two side limits, finding limits, limits at infinity, etc.")
 
 def expand_graph(req_json: dict) -> None:
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    cursor = conn.cursor()
+    graph_client = get_graph_client()
 
     gpt_4_llm = AzureChatOpenAI(deployment_name="gpt-4-turbo", api_version="2023-07-01-preview", model_name="gpt-4-1106-preview", temperature=0, max_retries=10)
 
@@ -94,10 +87,11 @@ def expand_graph(req_json: dict) -> None:
 
     extant_nodes = []
 
-    for node_id, table_id in zip(leaf_result[::2], leaf_result[1::2]):
-        cursor.execute("SELECT topic FROM nodes WHERE id = %s", (table_id,))
-        topic, = cursor.fetchone()
-        extant_nodes.append((node_id, topic))
+    with db_cursor() as cursor:
+        for node_id, table_id in zip(leaf_result[::2], leaf_result[1::2]):
+            cursor.execute("SELECT topic FROM nodes WHERE id = %s", (table_id,))
+            topic, = cursor.fetchone()
+            extant_nodes.append((node_id, topic))
 
     available_nodes = [x[1] for x in extant_nodes]
     leaves_enum_dict = {k:k for k in available_nodes}
@@ -156,13 +150,15 @@ def expand_graph(req_json: dict) -> None:
     INSERT INTO Nodes (topic, learning_status, masteries, blurb, public_name)
     VALUES (%s, %s, %s, %s, %s) RETURNING id;
     """
-    cursor.execute(insert_sql, (topic, [], json.dumps({mastery:False for mastery in masteries.masteries}), "You haven't started this node yet!", new_node_name))
-    node_id = cursor.fetchone()[0]
-    conn.commit()
+    with db_cursor() as cursor:
+        cursor.execute(insert_sql, (topic, [], json.dumps({mastery:False for mastery in masteries.masteries}), "You haven't started this node yet!", new_node_name))
+        node_id = cursor.fetchone()[0]
 
     node_add_callback = graph_client.submit(f"g.addV('{new_node_id}').property('user_id','{graph_expand_body.user_id}').property('table_id','{node_id}').property('lesson_id','-1').property('status','unstarted').property('pk','pk')")
     node_add_result = node_add_callback.all().result()
     new_node_graph_id = node_add_result[0].id
 
     node_add_callback = graph_client.submit(f"g.addV('{old_node_id}').addE('prerequisite').to(g.V('{new_node_graph_id}'))")
-    node_add_result = node_add_callback.all().result()
\ No newline at end of file
+    node_add_result = node_add_callback.all().result()
+
+    bump_graph_version(graph_expand_body.user_id, [old_node_id, new_node_graph_id])
\ No newline at end of file
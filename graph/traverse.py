@@ -1,60 +1,93 @@
 from typing import List
-from gremlin_python.driver import client, serializer
-import os
+from clients.gremlin import get_graph_client
 import logging
-from psycopg2 import pool
 from pydantic import BaseModel, Field
 from enum import Enum, auto
-from azure.storage.queue import QueueClient, TextBase64EncodePolicy, TextBase64DecodePolicy
 from langchain_openai import AzureChatOpenAI
 from langchain.output_parsers import OutputFixingParser, PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from operator import itemgetter
 import re
 import json
+from graph.cache import bump_graph_version
+from lesson.builds import dispatch_lesson_builds
 
-def send_update_message(node_id, user_id):
-    with QueueClient.from_connection_string(conn_str=os.environ['AzureWebJobsStorage'], 
-                                            queue_name="lesson-regenerate",
-                                            message_encode_policy = TextBase64EncodePolicy(),
-                                            message_decode_policy = TextBase64DecodePolicy()) as queue_client:
-        queue_client.send_message(json.dumps({"node_id": node_id, "user_id": user_id}))
-
-def traverse_graph(user_id: str) -> list[str]:
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
-    def update_node_status(node_id):
-        # Fetch the node and its status
-        cb = graph_client.submit(f"g.V('{node_id}').values('status')")
-        node_status = cb.all().result()[0]
+class NodeUpdatedMessage(BaseModel):
+    user_id: str
+    node_id: str = None
 
+def parse_node_updated_message(body: str) -> NodeUpdatedMessage:
+    # older messages carry only the bare user id
+    if body.lstrip().startswith("{"):
+        return NodeUpdatedMessage(**json.loads(body))
+    return NodeUpdatedMessage(user_id=body)
+
+def load_traversal_vertices(vertex_traversal: str) -> list[dict]:
+    # each vertex with its label, status, lesson, out-neighbours and the statuses of its parents, in one traversal
+    graph_client = get_graph_client()
+    callback = graph_client.submit(f"{vertex_traversal}.project('id', 'label', 'status', 'lesson_id', 'out', 'parent_statuses').by('id').by(label()).by('status').by('lesson_id').by(out().values('id').fold()).by(in().values('status').fold())")
+    return callback.all().result()
+
+def find_status_updates(vertices: list[dict], start_ids: list[str]) -> tuple[list[str], list[str]]:
+    """
+    Walks down from start_ids through 'completed' vertices and returns the 'unstarted' vertices whose
+    parents are all completed (ready for their first lesson) and the 'graded' vertices that need a new one.
+    """
+    statuses = {vertex['id']: vertex['status'] for vertex in vertices}
+    children = {vertex['id']: vertex['out'] for vertex in vertices}
+    parent_statuses = {vertex['id']: vertex['parent_statuses'] for vertex in vertices}
+
+    firstgen, regenerate = [], []
+    visited = set()
+    stack = list(start_ids)
+    while stack:
+        node_id = stack.pop()
+        # shared children in diamond-shaped graphs are only evaluated once
+        if node_id in visited or node_id not in statuses:
+            continue
+        visited.add(node_id)
+
+        node_status = statuses[node_id]
         if node_status in ['ready', 'scoring', 'regen', 'firstgen']:
             # Do not search children
-            return
+            continue
         elif node_status == 'completed':
             # Progress to children
-            child_id_callback = graph_client.submit(f"g.V('{node_id}').out().id()")
-            child_ids = child_id_callback.all().result()
-
-            for child_id in child_ids:
-                update_node_status(child_id)
+            stack.extend(children[node_id])
         elif node_status == 'graded':
             # Send out a message to update the level content
-            send_update_message(node_id, user_id)
+            regenerate.append(node_id)
         elif node_status == 'unstarted':
             # Check if all incoming nodes are 'completed'
-            invals_callback = graph_client.submit(f"g.V('{node_id}').in().values('status')")
-            invals = invals_callback.all().result()
-            if all(status == 'completed' for status in invals):
-                # Update status to 'firstgen' and send out a message
-                graph_client.submit(f"g.V('{node_id}').property('status', 'firstgen')")
-                send_update_message(node_id, user_id)
-    
-    gc_callback = graph_client.submit(f"g.V().hasLabel('start_node').has('user_id', '{user_id}').values('id')")
-    root_node_id = gc_callback.all().result()[0]
-    update_node_status(root_node_id)
-
-    
\ No newline at end of file
+            if all(status == 'completed' for status in parent_statuses[node_id]):
+                firstgen.append(node_id)
+
+    return firstgen, regenerate
+
+def traverse_graph(user_id: str, node_ids: list[str] = None) -> None:
+    """
+    Re-evaluates the user's graph below node_ids, the vertices whose status just changed, or below the
+    start node when no nodes are given.
+    """
+    graph_client = get_graph_client()
+
+    if not node_ids:
+        vertices = load_traversal_vertices(f"g.V().has('user_id', '{user_id}')")
+        start_ids = [vertex['id'] for vertex in vertices if vertex['label'] == 'start_node'][:1]
+    else:
+        # only the part of the graph the walk can reach: descendants through completed vertices
+        vertex_ids = ", ".join(f"'{node_id}'" for node_id in node_ids)
+        vertices = load_traversal_vertices(f"g.V({vertex_ids}).emit().repeat(has('status', 'completed').out()).dedup()")
+        start_ids = list(node_ids)
+
+    firstgen, regenerate = find_status_updates(vertices, start_ids)
+
+    if firstgen or regenerate:
+        # mark every node getting a lesson in one mutation: 'firstgen' for new nodes, 'regen' for graded ones.
+        # the walk skips both, so the node isn't dispatched again until build_lesson marks it 'ready'
+        vertex_ids = ", ".join(f"'{node_id}'" for node_id in firstgen + regenerate)
+        graph_client.submit(f"g.V({vertex_ids}).choose(has('status', 'graded'), property('status', 'regen'), property('status', 'firstgen'))").all().result()
+        bump_graph_version(user_id, firstgen + regenerate)
+
+    lesson_ids = {vertex['id']: vertex['lesson_id'] for vertex in vertices}
+    dispatch_lesson_builds(user_id, [(node_id, lesson_ids[node_id]) for node_id in firstgen + regenerate])
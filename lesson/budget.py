@@ -0,0 +1,46 @@
+import os
+import threading
+import time
+
+# how much one scene's agent loop may spend before the scene falls back to a title card
+SCENE_BUDGET_SECONDS = float(os.getenv("SCENE_BUDGET_SECONDS", 600))
+SCENE_BUDGET_TOKENS = int(os.getenv("SCENE_BUDGET_TOKENS", 60000))
+SCENE_BUDGET_RENDERS = int(os.getenv("SCENE_BUDGET_RENDERS", 6))
+# the full render of the accepted code may run at most this far past the scene's time budget
+SCENE_FINALIZE_GRACE_SECONDS = float(os.getenv("SCENE_FINALIZE_GRACE_SECONDS", 120))
+
+class SceneBudget:
+    """
+    Wall time, model tokens and renders spent on one scene. The agent loop checks it before every
+    model call and render instead of relying on the message count alone. Setting the cancelled
+    event (shared by every scene of a lesson) exhausts it at once.
+    """
+
+    def __init__(self, max_seconds: float = SCENE_BUDGET_SECONDS, max_tokens: int = SCENE_BUDGET_TOKENS,
+                 max_renders: int = SCENE_BUDGET_RENDERS, cancelled: threading.Event = None):
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.max_renders = max_renders
+        self.started_at = time.monotonic()
+        self.tokens = 0
+        self.renders = 0
+        self.cancelled = cancelled
+
+    def seconds_left(self) -> float:
+        return max(0.0, self.max_seconds - (time.monotonic() - self.started_at))
+
+    def add_tokens(self, tokens: int) -> None:
+        self.tokens += tokens
+
+    def add_render(self) -> None:
+        self.renders += 1
+
+    def is_cancelled(self) -> bool:
+        return self.cancelled is not None and self.cancelled.is_set()
+
+    def exhausted(self) -> bool:
+        return self.is_cancelled() or self.seconds_left() <= 0 or self.tokens >= self.max_tokens or self.renders >= self.max_renders
+
+    def summary(self) -> str:
+        return (f"{self.max_seconds - self.seconds_left():.0f}/{self.max_seconds:.0f}s, "
+                f"{self.tokens}/{self.max_tokens} tokens, {self.renders}/{self.max_renders} renders")
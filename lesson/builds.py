@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from clients.postgres import db_cursor
+from clients.queue import get_queue_client
+
+# a running build whose heartbeat stopped this long ago is assumed lost and may be claimed again;
+# a queued build left this long gets a new wake-up
+LESSON_BUILD_TIMEOUT_SECONDS = int(os.getenv("LESSON_BUILD_TIMEOUT_SECONDS", 3600))
+# how often a running build touches its row to show its worker is still alive
+LESSON_BUILD_HEARTBEAT_SECONDS = int(os.getenv("LESSON_BUILD_HEARTBEAT_SECONDS", 60))
+# builds running at once across all workers, matched to render and LLM capacity
+LESSON_BUILD_CONCURRENCY = int(os.getenv("LESSON_BUILD_CONCURRENCY", 4))
+# builds running at once for a single user, so one user's regens can't starve everyone else
+LESSON_BUILDS_PER_USER = int(os.getenv("LESSON_BUILDS_PER_USER", 1))
+# how long a wake-up message that found no claimable build waits before trying again
+LESSON_BUILD_RETRY_SECONDS = int(os.getenv("LESSON_BUILD_RETRY_SECONDS", 30))
+# a build that fails or is lost this many times is marked failed instead of being queued again
+LESSON_BUILD_MAX_ATTEMPTS = int(os.getenv("LESSON_BUILD_MAX_ATTEMPTS", 3))
+
+def dispatch_lesson_builds(user_id: str, builds: list[tuple[str, str]]) -> list[str]:
+    """
+    Queues a lesson build for each (node_id, generation) pair unless one is already queued or running.
+    The generation is the lesson id the node had when the build was requested ('-1' for its first
+    lesson), so finishing a build moves the node to a new generation. Returns the node ids queued.
+
+    Each queued build sends one message to lesson-regenerate, but the message is only a wake-up: the
+    worker that receives it runs whichever build claim_next_lesson_build picks.
+    """
+    if not builds:
+        return []
+
+    queued = []
+    with db_cursor() as cursor:
+        for node_id, generation in builds:
+            kind = 'firstgen' if generation == '-1' else 'regen'
+            cursor.execute("""
+            INSERT INTO lesson_builds (user_id, node_id, generation, kind) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (user_id, node_id, generation) DO UPDATE SET
+                state = 'queued',
+                attempts = CASE WHEN lesson_builds.state = 'failed' THEN 0 ELSE lesson_builds.attempts END,
+                updated_at = now()
+            WHERE lesson_builds.state = 'failed'
+               OR (lesson_builds.state = 'queued' AND lesson_builds.updated_at < now() - make_interval(secs => %s))
+            RETURNING node_id;
+            """, (str(user_id), node_id, generation, kind, LESSON_BUILD_TIMEOUT_SECONDS))
+            if cursor.fetchone() is not None:
+                queued.append((node_id, generation))
+
+    # only send once the rows are committed, so a fast worker always finds its build
+    queue_client = get_queue_client("lesson-regenerate")
+    for node_id, generation in queued:
+        queue_client.send_message(json.dumps({"node_id": node_id, "user_id": user_id, "generation": generation}))
+
+    skipped = len(builds) - len(queued)
+    if skipped:
+        logging.info(f"Skipped {skipped} lesson builds for user {user_id} that are already queued or running")
+
+    return [node_id for node_id, _ in queued]
+
+def claim_next_lesson_build() -> tuple[str, str, str]:
+    """
+    Marks the next build to run as running and returns its (user_id, node_id, generation), or None when
+    nothing may start right now. First lessons go before regenerations, users with fewer builds running
+    go first, and otherwise builds run in the order they were queued. Nothing starts while
+    LESSON_BUILD_CONCURRENCY builds are running, and no user gets more than LESSON_BUILDS_PER_USER.
+
+    A running build that hasn't moved in LESSON_BUILD_TIMEOUT_SECONDS is assumed lost with its worker
+    and can be claimed again, until it has been started LESSON_BUILD_MAX_ATTEMPTS times.
+    """
+    with db_cursor() as cursor:
+        # serialize claims across workers so the concurrency limits hold
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('lesson_builds_claim'))")
+
+        # lost builds that are out of attempts would otherwise stay running forever
+        cursor.execute("""
+        UPDATE lesson_builds SET state = 'failed', updated_at = now()
+        WHERE state = 'running' AND updated_at < now() - make_interval(secs => %s) AND attempts >= %s
+        """, (LESSON_BUILD_TIMEOUT_SECONDS, LESSON_BUILD_MAX_ATTEMPTS))
+
+        cursor.execute("SELECT count(*) FROM lesson_builds WHERE state = 'running' AND updated_at >= now() - make_interval(secs => %s)",
+                       (LESSON_BUILD_TIMEOUT_SECONDS,))
+        running, = cursor.fetchone()
+        if running >= LESSON_BUILD_CONCURRENCY:
+            return None
+
+        cursor.execute("""
+        WITH running AS (
+            SELECT user_id, count(*) AS builds FROM lesson_builds
+            WHERE state = 'running' AND updated_at >= now() - make_interval(secs => %s)
+            GROUP BY user_id
+        )
+        SELECT b.user_id, b.node_id, b.generation, b.kind, b.attempts, EXTRACT(EPOCH FROM (now() - b.created_at))
+        FROM lesson_builds b LEFT JOIN running r ON r.user_id = b.user_id
+        WHERE (b.state = 'queued' OR (b.state = 'running' AND b.updated_at < now() - make_interval(secs => %s)))
+          AND b.attempts < %s AND COALESCE(r.builds, 0) < %s
+        ORDER BY b.kind = 'firstgen' DESC, COALESCE(r.builds, 0), b.created_at
+        LIMIT 1;
+        """, (LESSON_BUILD_TIMEOUT_SECONDS, LESSON_BUILD_TIMEOUT_SECONDS, LESSON_BUILD_MAX_ATTEMPTS, LESSON_BUILDS_PER_USER))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        user_id, node_id, generation, kind, attempts, waited = row
+        cursor.execute("""
+        UPDATE lesson_builds SET state = 'running', attempts = attempts + 1, started_at = now(), updated_at = now()
+        WHERE user_id = %s AND node_id = %s AND generation = %s
+        """, (user_id, node_id, generation))
+
+    logging.info(f"Starting {kind} lesson build for user {user_id} node {node_id} (attempt {attempts + 1}) after waiting {float(waited):.1f}s")
+    return user_id, node_id, generation
+
+def has_pending_lesson_builds() -> bool:
+    # queued builds, and running ones that may still be claimed again if their worker was lost
+    with db_cursor() as cursor:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM lesson_builds WHERE state IN ('queued', 'running') AND attempts < %s)",
+                       (LESSON_BUILD_MAX_ATTEMPTS,))
+        return cursor.fetchone()[0]
+
+def requeue_wakeup(message: str) -> None:
+    # hand the wake-up back to the queue for later instead of blocking this worker
+    get_queue_client("lesson-regenerate").send_message(message, visibility_timeout=LESSON_BUILD_RETRY_SECONDS)
+
+def lesson_queue_stats() -> dict:
+    with db_cursor() as cursor:
+        cursor.execute("""
+        SELECT kind,
+               count(*) FILTER (WHERE state = 'queued'),
+               count(*) FILTER (WHERE state = 'running'),
+               COALESCE(MAX(EXTRACT(EPOCH FROM (now() - created_at))) FILTER (WHERE state = 'queued'), 0),
+               COALESCE(AVG(EXTRACT(EPOCH FROM (started_at - created_at))) FILTER (WHERE started_at >= now() - interval '1 hour'), 0)
+        FROM lesson_builds GROUP BY kind
+        """)
+        return {
+            kind: {
+                "queued": queued,
+                "running": running,
+                "oldest_queued_seconds": float(oldest_wait),
+                "mean_wait_seconds_last_hour": float(mean_wait),
+            }
+            for kind, queued, running, oldest_wait, mean_wait in cursor.fetchall()
+        }
+
+def touch_lesson_build(user_id: str, node_id: str, generation: str) -> None:
+    with db_cursor() as cursor:
+        cursor.execute("UPDATE lesson_builds SET updated_at = now() WHERE user_id = %s AND node_id = %s AND generation = %s AND state = 'running'",
+                       (str(user_id), node_id, generation))
+
+@contextmanager
+def lesson_build_heartbeat(user_id: str, node_id: str, generation: str):
+    # keeps a running build's updated_at fresh, so a slow build is never mistaken for a lost one
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(LESSON_BUILD_HEARTBEAT_SECONDS):
+            try:
+                touch_lesson_build(user_id, node_id, generation)
+            except Exception as e:
+                logging.warning(f"Could not update heartbeat of lesson build for node {node_id}: " + str(e))
+
+    thread = threading.Thread(target=beat, name=f"lesson-build-heartbeat-{node_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def finish_lesson_build(user_id: str, node_id: str, generation: str, succeeded: bool) -> bool:
+    """
+    Marks a claimed build done, or after a failure queues it again until it has been started
+    LESSON_BUILD_MAX_ATTEMPTS times. Returns True if the failed build was queued again.
+    """
+    with db_cursor() as cursor:
+        cursor.execute("""
+        UPDATE lesson_builds SET state = CASE WHEN %s THEN 'done' WHEN attempts < %s THEN 'queued' ELSE 'failed' END, updated_at = now()
+        WHERE user_id = %s AND node_id = %s AND generation = %s
+        RETURNING state
+        """, (succeeded, LESSON_BUILD_MAX_ATTEMPTS, str(user_id), node_id, generation))
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'queued'
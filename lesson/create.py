@@ -1,9 +1,11 @@
-import shutil
+import itertools
+import tempfile
+import threading
 from typing import List
-from gremlin_python.driver import client, serializer
+from clients.gremlin import get_graph_client
 import os
 import logging
-from psycopg2 import pool
+from clients.postgres import db_cursor
 from pydantic import BaseModel, Field
 from langchain_openai import AzureChatOpenAI
 from azure.storage.blob import BlobServiceClient
@@ -11,8 +13,12 @@ from langchain.output_parsers import OutputFixingParser, PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate
 from operator import itemgetter
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from lesson.video import VideoGeneratorAgent
+from lesson.video import VideoGeneratorAgent, scene_render_job
+from lesson.render import get_render_executor
 from lesson.audio import create_audio
+from grader.timeline import compute_visual_timeline, save_video_metadata, save_visual_timeline
+from graph.cache import bump_graph_version
+from lesson.builds import claim_next_lesson_build, finish_lesson_build, has_pending_lesson_builds, lesson_build_heartbeat, requeue_wakeup
 import re
 import json
 import uuid
@@ -22,6 +28,7 @@ from azure.storage.blob import BlobServiceClient
 class LessonCreateRequest(BaseModel):
     node_id: str = Field(description="The id of the node in the graph that needs a new lesson")
     user_id: str
+    generation: str = Field(default=None, description="The lesson id the node had when this build was queued")
 
 class QuizQuestion(BaseModel):
     question: str = Field(description="The question that the answers in the choices list belong to")
@@ -42,25 +49,45 @@ class Quiz(BaseModel):
     questions: list[QuizQuestion]
 
 def create_lesson(req_json: dict) -> None:
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    cursor = conn.cursor()
-
-    gpt_4_llm = AzureChatOpenAI(deployment_name="gpt-4-turbo", api_version="2023-07-01-preview", model_name="gpt-4-1106-preview", temperature=0, max_retries=10)
-
     try:
         data = LessonCreateRequest(**req_json)
     except Exception as e:
         logging.error("Could not parse create_lesson request: " + str(e))
-    
+
+    if data.generation is None:
+        # queued before lesson builds were tracked
+        build_lesson(data)
+        return
+
+    # the message only wakes a worker; the scheduler decides which build it runs
+    claimed = claim_next_lesson_build()
+    if claimed is None:
+        if has_pending_lesson_builds():
+            requeue_wakeup(json.dumps(req_json))
+        return
+
+    user_id, node_id, generation = claimed
+    try:
+        with lesson_build_heartbeat(user_id, node_id, generation):
+            build_lesson(LessonCreateRequest(node_id=node_id, user_id=user_id, generation=generation))
+    except Exception as e:
+        if not finish_lesson_build(user_id, node_id, generation, succeeded=False):
+            raise
+        # queued again; the wake-up comes back after a delay instead of retrying straight away
+        logging.error(f"Lesson build for user {user_id} node {node_id} failed and will be retried: " + str(e))
+        requeue_wakeup(json.dumps(req_json))
+        return
+    finish_lesson_build(user_id, node_id, generation, succeeded=True)
+
+def build_lesson(data: LessonCreateRequest) -> None:
+    graph_client = get_graph_client()
+
+    gpt_4_llm = AzureChatOpenAI(deployment_name="gpt-4-turbo", api_version="2023-07-01-preview", model_name="gpt-4-1106-preview", temperature=0, max_retries=10)
+
     # get records from learning style database
-    cursor.execute("SELECT learning_record FROM learning_records WHERE user_id=%s", (data.user_id,))
-    learning_records = cursor.fetchall()
+    with db_cursor() as cursor:
+        cursor.execute("SELECT learning_record FROM learning_records WHERE user_id=%s", (data.user_id,))
+        learning_records = cursor.fetchall()
 
     # get records from node id
     # g = traversal().withRemote(DriverRemoteConnection('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
@@ -69,8 +96,9 @@ def create_lesson(req_json: dict) -> None:
     tid_callback = graph_client.submit(f"g.V().has('id', '{data.node_id}').values('table_id')")
     table_id = tid_callback.all().result()[0]
     logging.info(table_id)
-    cursor.execute("SELECT learning_status, topic, masteries FROM nodes WHERE id=%s", (table_id,))
-    learning_status, topic, masteries = cursor.fetchone()
+    with db_cursor() as cursor:
+        cursor.execute("SELECT learning_status, topic, masteries FROM nodes WHERE id=%s", (table_id,))
+        learning_status, topic, masteries = cursor.fetchone()
 
     lp_parser = PydanticOutputParser(pydantic_object=LessonPlan)
     lp_fixing_parser = OutputFixingParser.from_llm(parser=lp_parser, llm=gpt_4_llm)
@@ -111,26 +139,39 @@ def create_lesson(req_json: dict) -> None:
 
     video_generator = VideoGeneratorAgent()
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = []
-        for i, scene in enumerate(lesson_plan.scenes):
-
-            if os.path.exists(f"scenes") and os.path.isdir(f"scenes"):
-                shutil.rmtree(f"scenes")
-
-            os.mkdir(f"scenes")
-            folder = os.path.join(os.getcwd(),f"scenes/")
-            futures.append(executor.submit(video_generator, scene.visuals, folder, i))
-            futures.append(executor.submit(create_audio, scene.audio, scene.visuals, folder, i))
-
-        for future in as_completed(futures):
-            future.result()
-
-    blobname = str(uuid.uuid4())
-    videos = [f"scenes/animation_{i}.mp4" for i in range(len(lesson_plan.scenes))]
-    audios = [f"scenes/voiceover_{i}.mp3" for i in range(len(lesson_plan.scenes))]
-
-    combine_audio_video_and_upload(videos, audios, f"{blobname}.mp4")
+    # every file this lesson renders lives here, so concurrent lessons and scenes never share paths
+    with tempfile.TemporaryDirectory(prefix="lesson-") as lesson_dir:
+        cancelled = threading.Event()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = []
+            for i, scene in enumerate(lesson_plan.scenes):
+                futures.append(executor.submit(video_generator, scene.visuals, lesson_dir, i, cancelled))
+                futures.append(executor.submit(create_audio, scene.audio, scene.visuals, lesson_dir, i))
+
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except Exception:
+                # one part failed, so stop the other scenes rather than wait on renders nobody will use
+                cancelled.set()
+                for future in futures:
+                    future.cancel()
+                for i in range(len(lesson_plan.scenes)):
+                    get_render_executor().cancel(scene_render_job(lesson_dir, i))
+                raise
+
+        blobname = str(uuid.uuid4())
+        videos = [os.path.join(lesson_dir, f"animation_{i}.mp4") for i in range(len(lesson_plan.scenes))]
+        audios = [os.path.join(lesson_dir, f"voiceover_{i}.mp3") for i in range(len(lesson_plan.scenes))]
+
+        final_clip_path, metadata = combine_audio_video_and_upload(videos, audios, f"{blobname}.mp4", lesson_dir)
+        save_video_metadata(f"{blobname}.mp4", **metadata)
+
+        # measure the video's visual change once here so grading never has to decode it
+        try:
+            save_visual_timeline(f"{blobname}.mp4", compute_visual_timeline(final_clip_path))
+        except Exception as e:
+            logging.error("Could not compute visual timeline for lesson video: " + str(e))
 
     quiz = {}
     for question, choices, correct_index in lesson_plan.quiz:
@@ -139,25 +180,27 @@ def create_lesson(req_json: dict) -> None:
             "correct_index": correct_index
         }
 
-    cursor.execute("INSERT INTO lessons (lesson_description, video_id, quiz) VALUES (%s, %s, %s) RETURNING id", (lesson_plan.lesson_description, f"{blobname}.mp4", json.dumps(quiz)))
-    lesson_id = cursor.fetchone()[0]
-    conn.commit()
+    with db_cursor() as cursor:
+        cursor.execute("INSERT INTO lessons (lesson_description, video_id, quiz) VALUES (%s, %s, %s) RETURNING id", (lesson_plan.lesson_description, f"{blobname}.mp4", json.dumps(quiz)))
+        lesson_id = cursor.fetchone()[0]
 
-    lidcb = graph_client.submit(f"g.V('{data.node_id}').property('lesson_id', '{lesson_id}')")
+    # the new lesson is live; traversal may dispatch this node again once it is graded
+    lidcb = graph_client.submit(f"g.V('{data.node_id}').property('lesson_id', '{lesson_id}').property('status', 'ready')")
     lidcb.all().result()
+    bump_graph_version(data.user_id, [data.node_id])
     tbncb = graph_client.submit(f"g.V('{data.node_id}').values('table_id')")
     table_id = tbncb.all().result()[0]
 
-    cursor.execute("SELECT lesson_ids FROM nodes WHERE id = %s", (table_id))
-    lesson_ids = cursor.fetchone()[0]
-    if lesson_ids is None:
-        lesson_ids = [lesson_id]
-    else:
-        lesson_ids.append(lesson_id)
-    cursor.execute("UPDATE nodes SET lesson_ids = %s WHERE id = %s", (lesson_ids, table_id))
-    conn.commit()
+    with db_cursor() as cursor:
+        cursor.execute("SELECT lesson_ids FROM nodes WHERE id = %s", (table_id,))
+        lesson_ids = cursor.fetchone()[0]
+        if lesson_ids is None:
+            lesson_ids = [lesson_id]
+        else:
+            lesson_ids.append(lesson_id)
+        cursor.execute("UPDATE nodes SET lesson_ids = %s WHERE id = %s", (lesson_ids, table_id))
 
-def combine_audio_video_and_upload(video_files, audio_files, output_filename):
+def combine_audio_video_and_upload(video_files, audio_files, output_filename, output_dir="/tmp"):
     combined_clips = []
 
     # Combine each video with its corresponding audio
@@ -170,7 +213,7 @@ def combine_audio_video_and_upload(video_files, audio_files, output_filename):
 
     # Concatenate the combined clips into one video
     final_clip = concatenate_videoclips(combined_clips)
-    final_clip_path = f"/tmp/{output_filename}"
+    final_clip_path = os.path.join(output_dir, output_filename)
     final_clip.write_videofile(final_clip_path, codec="libx264")
 
     # Upload the final video to Azure Blob Storage
@@ -181,4 +224,10 @@ def combine_audio_video_and_upload(video_files, audio_files, output_filename):
         blob_client.upload_blob(data, overwrite=True)
 
     print(f"Uploaded {output_filename} to Azure Blob Storage.")
+
+    # grading reads the lesson's length and scene layout from here instead of the video
+    scene_boundaries = [0.0, *itertools.accumulate(clip.duration for clip in combined_clips)]
+    metadata = {"duration": final_clip.duration, "fps": final_clip.fps, "scene_boundaries": scene_boundaries}
+
+    return final_clip_path, metadata
     
\ No newline at end of file
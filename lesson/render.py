@@ -0,0 +1,191 @@
+import atexit
+import logging
+import os
+import resource
+import signal
+import subprocess
+import threading
+import time
+import uuid
+from pydantic import BaseModel
+
+# renders are CPU bound, so by default one per core runs at a time and the rest wait their turn
+RENDER_CONCURRENCY = int(os.getenv("RENDER_CONCURRENCY", os.cpu_count() or 1))
+RENDER_TIMEOUT_SECONDS = float(os.getenv("RENDER_TIMEOUT_SECONDS", 600))
+RENDER_MEMORY_MB = int(os.getenv("RENDER_MEMORY_MB", 4096))
+
+class RenderResult(BaseModel):
+    job_id: str
+    stdout: str = ""
+    stderr: str = ""
+    returncode: int = None
+    timed_out: bool = False
+    cancelled: bool = False
+    wait_seconds: float = 0.0
+    render_seconds: float = 0.0
+
+    def succeeded(self) -> bool:
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+class RenderExecutor:
+    """
+    Runs render subprocesses for every lesson built by this worker process. At most max_concurrency
+    run at once and the rest queue for a slot. Each job gets a wall-clock timeout and an address-space
+    limit, runs in its own process group so the renderer's children die with it, and can be cancelled
+    by id whether it is still queued or already running. The timeout counts from submission, so time
+    spent waiting for a slot comes out of it.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        # jobs from submission until their result is recorded; _queued is the subset waiting for a slot
+        self._jobs: set[str] = set()
+        self._queued: set[str] = set()
+        self._running: dict[str, subprocess.Popen] = {}
+        self._cancelled: set[str] = set()
+        self._completed = 0
+        self._failed = 0
+        self._timed_out = 0
+        self._cancelled_count = 0
+        self._wait_seconds = 0.0
+        self._render_seconds = 0.0
+        self._max_render_seconds = 0.0
+
+    def run(self, args: list[str], cwd: str = None, job_id: str = None, timeout: float = RENDER_TIMEOUT_SECONDS,
+            memory_mb: int = RENDER_MEMORY_MB) -> RenderResult:
+        job_id = job_id or str(uuid.uuid4())
+        with self._lock:
+            self._jobs.add(job_id)
+            self._queued.add(job_id)
+
+        started = time.monotonic()
+        deadline = started + timeout
+        try:
+            # wake up now and then so a job cancelled while queued gives up its place
+            while not self._slots.acquire(timeout=max(0, min(1, deadline - time.monotonic()))):
+                if self._is_cancelled(job_id):
+                    return self._finish(RenderResult(job_id=job_id, cancelled=True, wait_seconds=time.monotonic() - started))
+                if time.monotonic() >= deadline:
+                    return self._finish(RenderResult(job_id=job_id, timed_out=True, wait_seconds=time.monotonic() - started))
+        finally:
+            with self._lock:
+                self._queued.discard(job_id)
+        waited = time.monotonic() - started
+
+        try:
+            if self._is_cancelled(job_id):
+                return self._finish(RenderResult(job_id=job_id, cancelled=True, wait_seconds=waited))
+            return self._finish(self._render(args, cwd, job_id, max(0, deadline - time.monotonic()), memory_mb, waited))
+        finally:
+            self._slots.release()
+
+    def _render(self, args, cwd, job_id, timeout, memory_mb, waited) -> RenderResult:
+        started = time.monotonic()
+        try:
+            process = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        except OSError as e:
+            return RenderResult(job_id=job_id, stderr=str(e), wait_seconds=waited)
+        try:
+            # set from outside: preexec_fn is not safe in a multithreaded worker
+            memory_limit = memory_mb * 1024 * 1024
+            resource.prlimit(process.pid, resource.RLIMIT_AS, (memory_limit, memory_limit))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not limit memory of render {job_id}: " + str(e))
+
+        with self._lock:
+            self._running[job_id] = process
+            cancelled = job_id in self._cancelled
+        if cancelled:
+            # cancelled while the process was starting
+            self._kill(process)
+
+        timed_out = False
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            self._kill(process)
+            stdout, stderr = process.communicate()
+        finally:
+            with self._lock:
+                self._running.pop(job_id, None)
+
+        return RenderResult(
+            job_id=job_id,
+            stdout=stdout.decode("utf-8", errors="replace"),
+            stderr=stderr.decode("utf-8", errors="replace"),
+            returncode=process.returncode,
+            timed_out=timed_out,
+            cancelled=self._is_cancelled(job_id),
+            wait_seconds=waited,
+            render_seconds=time.monotonic() - started,
+        )
+
+    def _kill(self, process: subprocess.Popen) -> None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _is_cancelled(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._cancelled
+
+    def _finish(self, result: RenderResult) -> RenderResult:
+        with self._lock:
+            self._jobs.discard(result.job_id)
+            self._cancelled.discard(result.job_id)
+            self._wait_seconds += result.wait_seconds
+            self._render_seconds += result.render_seconds
+            self._max_render_seconds = max(self._max_render_seconds, result.render_seconds)
+            if result.cancelled:
+                self._cancelled_count += 1
+            elif result.timed_out:
+                self._timed_out += 1
+            elif result.returncode == 0:
+                self._completed += 1
+            else:
+                self._failed += 1
+
+        logging.info(f"Render {result.job_id} returned {result.returncode} after waiting {result.wait_seconds:.1f}s "
+                     f"and rendering {result.render_seconds:.1f}s" + (" (timed out)" if result.timed_out else "")
+                     + (" (cancelled)" if result.cancelled else ""))
+        return result
+
+    def cancel(self, job_id: str) -> bool:
+        # True if the job was queued or running; a running render is killed
+        with self._lock:
+            if job_id not in self._jobs:
+                return False
+            self._cancelled.add(job_id)
+            process = self._running.get(job_id)
+        if process is not None:
+            self._kill(process)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queued": len(self._queued),
+                "running": len(self._running),
+                "completed": self._completed,
+                "failed": self._failed,
+                "timed_out": self._timed_out,
+                "cancelled": self._cancelled_count,
+                "total_wait_seconds": self._wait_seconds,
+                "total_render_seconds": self._render_seconds,
+                "max_render_seconds": self._max_render_seconds,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            processes = list(self._running.values())
+        for process in processes:
+            self._kill(process)
+
+_render_executor = RenderExecutor(RENDER_CONCURRENCY)
+atexit.register(_render_executor.close)
+
+def get_render_executor() -> RenderExecutor:
+    return _render_executor
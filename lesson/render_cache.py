@@ -0,0 +1,77 @@
+import ast
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+from importlib import metadata
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from clients.blob import get_container_client
+from clients.blob_cache import get_blob_cache
+
+# finished renders are shared by every worker through this container and kept on local disk
+RENDER_CACHE_CONTAINER = os.getenv("RENDER_CACHE_CONTAINER", "render-cache")
+
+@functools.lru_cache(maxsize=None)
+def _manim_version() -> str:
+    try:
+        return metadata.version("manim")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+def _normalize_code(manim_code: str) -> str:
+    # parsing and unparsing drops comments, blank lines and formatting, which don't change the render
+    try:
+        return ast.unparse(ast.parse(manim_code))
+    except SyntaxError:
+        return "\n".join(line.rstrip() for line in manim_code.strip().splitlines() if line.strip())
+
+@functools.lru_cache(maxsize=None)
+def _ensure_container() -> None:
+    # created on first use by each process; nothing else provisions it
+    try:
+        get_container_client(RENDER_CACHE_CONTAINER).create_container()
+    except ResourceExistsError:
+        pass
+
+def render_cache_key(manim_code: str, class_name: str, flags: list[str]) -> str:
+    key_source = json.dumps([_normalize_code(manim_code), class_name, flags, _manim_version()])
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+def get_cached_render(key: str, destination: str) -> str:
+    """
+    Copies a cached render's video to destination and returns the stderr recorded with it, or None
+    when nothing was cached under key.
+    """
+    cache = get_blob_cache(RENDER_CACHE_CONTAINER)
+    try:
+        with cache.local_copy(f"{key}.json") as output_path:
+            with open(output_path) as output_file:
+                output = json.load(output_file)
+        with cache.local_copy(f"{key}.mp4") as video_path:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copyfile(video_path, destination)
+    except ResourceNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning("Could not read cached render: " + str(e))
+        return None
+    return output["stderr"]
+
+def cache_render(key: str, video_path: str, stderr: str) -> None:
+    # only successful renders are cached; a failure to cache never fails the render
+    cache = get_blob_cache(RENDER_CACHE_CONTAINER)
+    output_path = f"{video_path}.json"
+    try:
+        _ensure_container()
+        with open(output_path, "w") as output_file:
+            json.dump({"stderr": stderr}, output_file)
+        # the video goes first so a reader that finds the output always finds the video
+        cache.put(f"{key}.mp4", video_path)
+        cache.put(f"{key}.json", output_path)
+    except Exception as e:
+        logging.warning("Could not cache render: " + str(e))
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
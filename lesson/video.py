@@ -1,4 +1,5 @@
 import ast
+import glob
 import logging
 import operator
 from typing import Annotated, Dict, List, Optional, Sequence, Type, TypedDict
@@ -18,7 +19,8 @@ from operator import itemgetter
 import re
 import json
 import os
-import subprocess
+import tempfile
+import textwrap
 from ansi2html import Ansi2HTMLConverter
 
 from langchain.callbacks.manager import (
@@ -30,7 +32,15 @@ from langgraph.graph import StateGraph, END
 from azure.storage.blob import BlobServiceClient
 from langchain.load.dump import dumps
 from langchain.load.load import loads
-import random
+from lesson.render import RENDER_TIMEOUT_SECONDS, get_render_executor
+from lesson.render_cache import cache_render, get_cached_render, render_cache_key
+from lesson.budget import SCENE_FINALIZE_GRACE_SECONDS, SceneBudget
+from langchain.callbacks import get_openai_callback
+
+# how long a fallback title card stays on screen
+TITLE_CARD_SECONDS = float(os.getenv("TITLE_CARD_SECONDS", 10))
+# a title card is a few lines of text, so a render that takes longer than this is stuck
+TITLE_CARD_RENDER_SECONDS = float(os.getenv("TITLE_CARD_RENDER_SECONDS", 60))
 
 class CodeGenerateSchema(BaseModel):
     manim_code: str = Field(description="Manim code that generates the visuals for the scene. Treat this field as the equivalent to a .py file; it must be NOTHING BUT Python code and be able to be executed with manim -pql scene.py <class_name> AS-IS.")
@@ -79,45 +89,114 @@ class CodeCreateState(TypedDict):
     memory: str
     desired_visual: str
     gen_num: str
+    # lesson folder the finished animation is copied to, and this scene's private render directory
+    folder: str
+    workspace: str
+    # the last code whose preview rendered; finalize renders it in full
+    accepted_code: dict
+    budget: SceneBudget
 
 class VideoGenerate(BaseTool):
     name = "RenderVideo"
     description = "Attempts to render the provided code into a video file and provides the stdout and stderr of the render process. This tool returns the stderr of the command line so you can tell what went wrong; if it generated correctly there won't be output. However, it will be automatically sent to your client for their review, and they'll reach out to you with feedback"
     args_schema: Type[BaseModel] = CodeGenerateSchema
     conv = Ansi2HTMLConverter()
+    # directory owned by one scene; scene.py and manim's media/ are written inside it
+    workspace: str = None
+    timeout: float = RENDER_TIMEOUT_SECONDS
+    job_id: str = None
 
     model_config = ConfigDict(from_attributes=True)
 
     def _run(self, manim_code: str, class_name: str, desired_visual: str, run_manager: Optional[CallbackManagerForToolRun] = None) -> str:
         """generate a video synchronously."""
+        # while the agent iterates only the last frame is rendered; the accepted code is rendered in full once
+        stdout_decoded, stderr_decoded = self.render(manim_code, class_name, preview=True)
+
+        stdout_html = self.conv.convert(stdout_decoded)
+        stderr_html = self.conv.convert(stderr_decoded)
+
+        return stdout_html, stderr_html, manim_code, desired_visual
+
+    def render(self, manim_code: str, class_name: str, preview: bool = False) -> tuple[str, str]:
+        """
+        Renders the scene in this tool's workspace and returns manim's stdout and stderr. A preview
+        (manim -s) still runs construct() to the end, so it hits the same exceptions, but only writes
+        the final frame as an image.
+        """
+        scene_path = os.path.join(self.workspace, "scene.py")
+        media_dir = os.path.join(self.workspace, "media")
 
         # get rid of old generation stuff
-        if os.path.isfile("scene.py"):
-            os.remove("scene.py")
-        if os.path.isdir("media"):
-            shutil.rmtree("media")
+        if os.path.isdir(media_dir):
+            shutil.rmtree(media_dir)
 
         # write the code to a file
-        with open("scene.py", "w") as scene:
+        with open(scene_path, "w") as scene:
             scene.write(manim_code)
 
-        stdout, stderr = subprocess.Popen(f"manim -pql scene.py {class_name}", stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True).communicate()
-        stdout_decoded = stdout.decode('utf-8')
-        stderr_decoded = stderr.decode('utf-8')
-
-        stdout_html = self.conv.convert(stdout_decoded)
-        stderr_html = self.conv.convert(stderr_decoded)
-
-        return stdout_html, stderr_html, manim_code, desired_visual
+        flags = ["-ql", "-s"] if preview else ["-ql"]
+        if not preview:
+            cache_key = render_cache_key(manim_code, class_name, flags)
+            cached_path = os.path.join(media_dir, "cached", f"{class_name}.mp4")
+            cached_stderr = get_cached_render(cache_key, cached_path)
+            if cached_stderr is not None:
+                # the same code was already rendered, here or by another lesson
+                return f"Reused an identical earlier render.\nFile ready at '{cached_path}'", cached_stderr
+
+        # queued behind other lessons' renders, and killed if it runs away
+        result = get_render_executor().run(["manim", *flags, "--media_dir", media_dir, scene_path, class_name],
+                                           cwd=self.workspace, job_id=self.job_id, timeout=self.timeout)
+        stdout_decoded = result.stdout
+        stderr_decoded = result.stderr
+        if result.timed_out and result.returncode is None:
+            stderr_decoded += "\nRender never started: the render queue is full and this scene is out of time."
+        elif result.timed_out:
+            stderr_decoded += f"\nRender was stopped after {self.timeout:.0f} seconds; make the animation shorter or simpler."
+
+        if not preview and result.succeeded():
+            rendered = glob.glob(os.path.join(media_dir, "videos", "*", "*", f"{class_name}.mp4"))
+            if rendered:
+                cache_render(cache_key, rendered[0], stderr_decoded)
+
+        return stdout_decoded, stderr_decoded
         
     def _arun(self, run_manager: Optional[AsyncCallbackManagerForToolRun] = None) -> str:
         """Generate a video segment asynchronously."""
         raise NotImplementedError("TextGenerate does not support async")
     
+def scene_render_job(folder: str, gen_num) -> str:
+    # every render of one scene runs under this id, so the lesson can cancel whichever is running
+    return f"{os.path.basename(folder)}-scene-{gen_num}"
+
+def _rendered_file(stdout: str) -> str:
+    # path from manim's "File ready at" line, which it may wrap across lines; None if the render failed
+    html_obliterator = re.compile('<.*?>') 
+    stdout_plain = re.sub(html_obliterator, '', stdout)
+    stdout_plain = stdout_plain.replace("\n", "")
+    stdout_plain = "".join(stdout_plain.split())
+    match = re.compile(r"Filereadyat'([^']+)'").search(stdout_plain)
+    return None if match is None else match.group(1)
+
+def _title_card_scene(text: str) -> tuple[str, str]:
+    # fixed scene code, so it always renders and identical cards come from the render cache
+    wrapped = textwrap.fill(" ".join(text.split()), width=48)
+    manim_code = f"""from manim import *
+
+class TitleCard(Scene):
+    def construct(self):
+        card = Text({json.dumps(wrapped)}, font_size=32, line_spacing=1.2)
+        if card.width > config.frame_width - 1:
+            card.scale_to_fit_width(config.frame_width - 1)
+        if card.height > config.frame_height - 1:
+            card.scale_to_fit_height(config.frame_height - 1)
+        self.play(FadeIn(card))
+        self.wait({TITLE_CARD_SECONDS})
+"""
+    return manim_code, "TitleCard"
+
 class VideoGeneratorAgent:
-    tool_executor: ToolExecutor
     chat: AzureChatOpenAI
-    folder: str = None
 
     def __init__(self):
         gpt_4_llm = AzureChatOpenAI(deployment_name="gpt-4-turbo", api_version="2023-07-01-preview", model_name="gpt-4-1106-preview", temperature=0, max_retries=10)
@@ -137,7 +216,6 @@ class VideoGeneratorAgent:
 
         tools = [VideoGenerate()]
         tools_oai = [format_tool_to_openai_tool(tool) for tool in tools]
-        self.tool_executor = ToolExecutor(tools)
         self.chat = gpt_4_llm.bind(tools=tools_oai)
 
         workflow = StateGraph(CodeCreateState)
@@ -149,23 +227,30 @@ class VideoGeneratorAgent:
             self.should_continue,
             {
                 "continue": "action",
-                "end": END
+                "end": "finalize"
             }
         )
         workflow.add_edge("action", "agent")
+        workflow.add_node("finalize", self.finalize)
+        workflow.add_edge("finalize", END)
         self.app = workflow.compile()
 
-    def __call__(self, prompt, folder, i):
-        self.folder = folder
-        resp = self.app.invoke({
-            "messages": [
-                ("system", f"You are a developer whose job it is to write a python file which can be run using manim -pql scene.py ClassName to generate the animation or visual that your client requests. Don't respond with anything except for the tool call and a 1 sentence explanation of what you did or are fixing. Don't keep trying something that isn't working; instead, switch to a different approach. Keep improving the video according to the customer's feedback until they are satisfied and say that there is no more work to be done. You remember this about similar jobs: {self.memory}"),
-                ("user", f"Here's what I want you to do: {prompt}. Time is of the essence, so I'll pay you a large bonus if you get this done fast."),
-            ],
-            "memory": self.memory,
-            "desired_visual": prompt,
-            "gen_num": i
-        })
+    def __call__(self, prompt, folder, i, cancelled=None):
+        # one agent serves every scene of a lesson in parallel, so per-scene paths travel in the graph state
+        with tempfile.TemporaryDirectory(prefix=f"scene-{i}-", dir=folder) as workspace:
+            resp = self.app.invoke({
+                "messages": [
+                    ("system", f"You are a developer whose job it is to write a python file which can be run using manim -pql scene.py ClassName to generate the animation or visual that your client requests. Don't respond with anything except for the tool call and a 1 sentence explanation of what you did or are fixing. Don't keep trying something that isn't working; instead, switch to a different approach. Keep improving the video according to the customer's feedback until they are satisfied and say that there is no more work to be done. You remember this about similar jobs: {self.memory}"),
+                    ("user", f"Here's what I want you to do: {prompt}. Time is of the essence, so I'll pay you a large bonus if you get this done fast."),
+                ],
+                "memory": self.memory,
+                "desired_visual": prompt,
+                "gen_num": i,
+                "folder": folder,
+                "workspace": workspace,
+                "accepted_code": None,
+                "budget": SceneBudget(cancelled=cancelled),
+            })
 
         return folder
 
@@ -174,6 +259,11 @@ class VideoGeneratorAgent:
         messages = state["messages"]
         last_message = messages[-1]
 
+        if state["budget"].exhausted():
+            # no reflection either; this scene has already cost too much
+            logging.warning(f"Scene {state['gen_num']} ran out of budget ({state['budget'].summary()})")
+            return "end"
+
         if "tool_calls" not in last_message.additional_kwargs or len(messages) > 10: # this means 5 tool calls
             reflection_prompts = ChatPromptTemplate.from_messages(
                 [
@@ -213,8 +303,13 @@ class VideoGeneratorAgent:
             return "continue"
         
     def call_model(self, state: CodeCreateState) -> Dict[str, list[BaseMessage]]:
+        if state["budget"].exhausted():
+            return {"messages": []}
+
         messages = state['messages']
-        response = self.chat.invoke(messages)
+        with get_openai_callback() as usage:
+            response = self.chat.invoke(messages)
+        state["budget"].add_tokens(usage.total_tokens)
         return {"messages": [response]}
 
     def call_tool(self, state: CodeCreateState) -> Dict[str, list[BaseMessage]]:
@@ -225,18 +320,29 @@ class VideoGeneratorAgent:
 
         calls = [ x for x in last_message.additional_kwargs["tool_calls"] ]
         resp_messages = []
+        accepted_code = state.get("accepted_code")
+        budget = state["budget"]
 
         for call in calls:
             call_type = call["type"]
             call_id = call["id"]
 
+            # every tool call still needs an answer, even the ones that don't get to render
+            if budget.exhausted():
+                resp_messages.append(ToolMessage(content="Not rendered: this scene is out of time or render budget.", tool_call_id=call_id))
+                continue
+            budget.add_render()
+
             action = ToolInvocation(
                 tool=call[call_type]["name"],
                 tool_input=json.loads(call[call_type]["arguments"]),
             )
+            # a render may not run past the scene's deadline
+            tool_executor = ToolExecutor([VideoGenerate(workspace=state["workspace"], job_id=scene_render_job(state["folder"], state["gen_num"]),
+                                                        timeout=min(RENDER_TIMEOUT_SECONDS, budget.seconds_left()))])
 
             #stdout, stderr, manim_code
-            stdout, stderr, manim_code, desired_visual = self.tool_executor.invoke(action)
+            stdout, stderr, manim_code, desired_visual = tool_executor.invoke(action)
 
             # add tool message to output
             tool_message = ToolMessage(content=str(stderr), tool_call_id=call_id)
@@ -272,21 +378,44 @@ class VideoGeneratorAgent:
             #     else:
             #         resp_messages.append(HumanMessage(content=f"There are some things I need you to change. Here is my list: {code_correctness_output.issues}"))
 
-            # copy file to saved spot
-            try:
-                html_obliterator = re.compile('<.*?>') 
-                stdout_plain = re.sub(html_obliterator, '', stdout)
-                stdout_plain = stdout_plain.replace("\n", "")
-                stdout_plain = "".join(stdout_plain.split())
-                url = re.compile(r"Filereadyat'([^']+)'").search(stdout_plain).group(1)
-                logging.info(self.folder)
-                logging.info(url)
-                rdi = random.randint(0, 100000)
-                shutil.copyfile(url, os.path.join(self.folder, f"animation_{state['gen_num']}.mp4"))
-            except Exception as e:
-                pass
-
-        return {"messages": resp_messages}
+            if _rendered_file(stdout) is not None:
+                accepted_code = {"manim_code": manim_code, "class_name": action.tool_input["class_name"]}
+
+        return {"messages": resp_messages, "accepted_code": accepted_code}
+
+    def finalize(self, state: CodeCreateState) -> Dict[str, list[BaseMessage]]:
+        if state["budget"].is_cancelled():
+            # the lesson failed elsewhere; nothing will use this scene
+            return {"messages": []}
+
+        # the one full render, of the last code that previewed cleanly, bounded by what's left of the budget plus a grace period
+        job_id = scene_render_job(state["folder"], state["gen_num"])
+        accepted_code = state.get("accepted_code")
+        url = None
+        if accepted_code is not None:
+            timeout = min(RENDER_TIMEOUT_SECONDS, state["budget"].seconds_left() + SCENE_FINALIZE_GRACE_SECONDS)
+            render_tool = VideoGenerate(workspace=state["workspace"], job_id=job_id, timeout=timeout)
+            stdout, stderr = render_tool.render(accepted_code["manim_code"], accepted_code["class_name"])
+            url = _rendered_file(stdout)
+            if url is None:
+                logging.error(f"Could not render animation for scene {state['gen_num']}: " + stderr)
+
+        if url is None:
+            # the lesson still ships: show the scene's description on a title card instead
+            logging.warning(f"Using a title card for scene {state['gen_num']} ({state['budget'].summary()})")
+            title_card_tool = VideoGenerate(workspace=state["workspace"], job_id=job_id, timeout=TITLE_CARD_RENDER_SECONDS)
+            stdout, stderr = title_card_tool.render(*_title_card_scene(state["desired_visual"]))
+            url = _rendered_file(stdout)
+            if url is None:
+                logging.error(f"Could not render title card for scene {state['gen_num']}: " + stderr)
+                return {"messages": []}
+
+        # copy file to saved spot
+        logging.info(state["folder"])
+        logging.info(url)
+        shutil.copyfile(url, os.path.join(state["folder"], f"animation_{state['gen_num']}.mp4"))
+
+        return {"messages": []}
 
     # def combine_audio_video(self, audio, video, output):
     #     subprocess.call(["ffmpeg", "-i", audio, "-i", video, "-c:v", "copy", "-filter:a", "aresample=async=1", "-c:a", "flac", "-strict", "-2", output])
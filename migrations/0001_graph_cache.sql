@@ -0,0 +1,18 @@
+-- graph versions, cached structures and the change log behind getGraphStructure/getGraphChanges
+CREATE TABLE IF NOT EXISTS graph_versions (
+    user_id TEXT PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS graph_structure_cache (
+    user_id TEXT PRIMARY KEY,
+    version BIGINT NOT NULL,
+    structure JSONB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS graph_changes (
+    user_id TEXT NOT NULL,
+    version BIGINT NOT NULL,
+    node_id TEXT NOT NULL,
+    PRIMARY KEY (user_id, version, node_id)
+);
+-- changes are logged for every version above log_floor; NULL means nothing has been logged yet
+ALTER TABLE graph_versions ADD COLUMN IF NOT EXISTS log_floor BIGINT;
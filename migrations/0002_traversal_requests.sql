@@ -0,0 +1,9 @@
+-- per-user traversal requests merged under a lease
+CREATE TABLE IF NOT EXISTS traversal_requests (
+    user_id TEXT PRIMARY KEY,
+    pending_nodes TEXT[] NOT NULL DEFAULT '{}',
+    full_traversal BOOLEAN NOT NULL DEFAULT FALSE,
+    last_requested_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    lease_owner TEXT,
+    lease_expires_at TIMESTAMPTZ
+);
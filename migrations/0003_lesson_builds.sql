@@ -0,0 +1,13 @@
+-- lesson builds: dispatch dedupe and the scheduler's work queue
+CREATE TABLE IF NOT EXISTS lesson_builds (
+    user_id TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    generation TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_id, node_id, generation)
+);
+ALTER TABLE lesson_builds ADD COLUMN IF NOT EXISTS kind TEXT NOT NULL DEFAULT 'regen';
+ALTER TABLE lesson_builds ADD COLUMN IF NOT EXISTS started_at TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS lesson_builds_state ON lesson_builds (state, kind, created_at);
@@ -0,0 +1,11 @@
+-- gaze samples from each viewing, kept until gradeQuiz scores them
+CREATE TABLE IF NOT EXISTS lesson_sessions (
+    id BIGSERIAL PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    vision_points JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+-- new sessions store their samples packed in vision_columns; vision_points is kept for older ones
+ALTER TABLE lesson_sessions ADD COLUMN IF NOT EXISTS vision_columns BYTEA;
+ALTER TABLE lesson_sessions ALTER COLUMN vision_points DROP NOT NULL;
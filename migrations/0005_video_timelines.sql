@@ -0,0 +1,6 @@
+-- per-video visual-change timelines measured at lesson creation
+CREATE TABLE IF NOT EXISTS video_timelines (
+    video_id TEXT PRIMARY KEY,
+    timeline BYTEA NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,7 @@
+-- per-video duration, fps and scene boundaries for pace scoring
+CREATE TABLE IF NOT EXISTS video_metadata (
+    video_id TEXT PRIMARY KEY,
+    duration DOUBLE PRECISION NOT NULL,
+    fps DOUBLE PRECISION NOT NULL,
+    scene_boundaries DOUBLE PRECISION[] NOT NULL
+);
@@ -0,0 +1,2 @@
+-- how many times each build has been started, so failed and lost builds are retried a bounded number of times
+ALTER TABLE lesson_builds ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
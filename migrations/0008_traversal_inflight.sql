@@ -0,0 +1,3 @@
+-- requests the lease holder has taken but not finished traversing; the next holder takes them over if it dies
+ALTER TABLE traversal_requests ADD COLUMN IF NOT EXISTS inflight_nodes TEXT[] NOT NULL DEFAULT '{}';
+ALTER TABLE traversal_requests ADD COLUMN IF NOT EXISTS inflight_full BOOLEAN NOT NULL DEFAULT FALSE;
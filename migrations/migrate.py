@@ -0,0 +1,57 @@
+import logging
+import os
+import psycopg2
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+# any fixed key works as long as nothing else takes the same advisory lock
+MIGRATIONS_LOCK_KEY = 7240101
+
+def pending_migrations(cursor) -> list[str]:
+    cursor.execute("SELECT version FROM schema_migrations")
+    applied = {row[0] for row in cursor.fetchall()}
+    return [name for name in sorted(os.listdir(MIGRATIONS_DIR)) if name.endswith(".sql") and name not in applied]
+
+def migrate(conn_string: str) -> list[str]:
+    """
+    Applies every .sql file in this directory that hasn't been applied yet, in name order, each in
+    its own transaction together with its schema_migrations row. Runs at deploy time, before the new
+    code starts, so request handlers never run DDL. Returns the names of the files applied.
+    """
+    conn = psycopg2.connect(conn_string)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version TEXT PRIMARY KEY,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            # two deploys racing each other apply each file once
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+        conn.commit()
+
+        applied = []
+        try:
+            with conn.cursor() as cursor:
+                names = pending_migrations(cursor)
+            for name in names:
+                with open(os.path.join(MIGRATIONS_DIR, name)) as migration_file:
+                    ddl = migration_file.read()
+                with conn.cursor() as cursor:
+                    cursor.execute(ddl)
+                    cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (name,))
+                conn.commit()
+                logging.info(f"Applied migration {name}")
+                applied.append(name)
+        finally:
+            conn.rollback()
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+            conn.commit()
+        return applied
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate(os.getenv("MIGRATIONS_CONN_STRING") or os.getenv("POSTGRES_CONN_STRING"))
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+structural_similarity = pytest.importorskip("skimage.metrics").structural_similarity
+
+from grader.ssim import consecutive_ssim, overlapping_batches
+
+def _frames(count, height=48, width=64, seed=0):
+    # noise with a drifting gradient, so consecutive frames are related but never identical
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 128, width)[None, :]
+    return np.stack([
+        np.clip(gradient + 4 * i + rng.normal(0, 30, (height, width)), 0, 255).astype(np.uint8)
+        for i in range(count)
+    ])
+
+def _skimage_ssim(frames):
+    return np.array([structural_similarity(frames[i], frames[i + 1], data_range=255) for i in range(len(frames) - 1)])
+
+def test_consecutive_ssim_matches_skimage():
+    frames = _frames(10)
+    np.testing.assert_allclose(consecutive_ssim(frames), _skimage_ssim(frames), rtol=0, atol=1e-6)
+
+def test_consecutive_ssim_needs_two_frames():
+    assert consecutive_ssim(_frames(1)).shape == (0,)
+
+@pytest.mark.parametrize("count, batch_size", [(10, 4), (9, 4), (8, 2), (5, 8)])
+def test_overlapping_batches_match_skimage(count, batch_size):
+    frames = _frames(count, seed=count)
+    times = np.arange(count) / 4.0
+
+    batched_times, batched_ssim = [], []
+    for batch_times, batch in overlapping_batches(zip(times, frames), batch_size=batch_size):
+        assert len(batch) <= batch_size
+        # each pair's value is keyed by the time of its second frame
+        batched_times.extend(batch_times[1:])
+        batched_ssim.extend(consecutive_ssim(batch))
+
+    np.testing.assert_array_equal(batched_times, times[1:])
+    np.testing.assert_allclose(batched_ssim, _skimage_ssim(frames), rtol=0, atol=1e-6)
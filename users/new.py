@@ -1,7 +1,6 @@
-from gremlin_python.driver import client, serializer
-import os
+from clients.gremlin import get_graph_client
 import logging
-from psycopg2 import pool
+from clients.postgres import db_cursor
 from pydantic import BaseModel, Field
 from enum import Enum
 import json
@@ -172,22 +171,15 @@ class UserCreateRequest(BaseModel):
     interests: list[str] = Field(description="The interests of the user")
 
 def create_new_user(req_json: dict) -> int:
-    graph_client = client.Client('wss://guidestone-gremlin.gremlin.cosmos.azure.com:443/','g', 
-                    username=f"/dbs/guidestone/colls/knowledge-graph", 
-                    password=os.getenv("KNOWLEDGE_GRAPH_KEY"),
-                    message_serializer=serializer.GraphSONSerializersV2d0())
-    
-    postgreSQL_pool = pool.SimpleConnectionPool(1, int(os.getenv("PYTHON_THREADPOOL_THREAD_COUNT")), os.getenv("POSTGRES_CONN_STRING"))  
-    conn = postgreSQL_pool.getconn()
-    cursor = conn.cursor()
+    graph_client = get_graph_client()
 
     try:
         create_user_body = UserCreateRequest(**req_json)
     except Exception as e:
         logging.error("Could not parse user creation request: " + str(e))
 
-    # add user to postgres
-    try:
+    with db_cursor() as cursor:
+        # add user to postgres
         name = create_user_body.name
         email = create_user_body.email
         profile_pic_url = create_user_body.profile_pic_url
@@ -201,22 +193,16 @@ def create_new_user(req_json: dict) -> int:
         """
         cursor.execute(insert_sql, (name, email, profile_pic_url, grade_level, interests, base_knowledge))
         user_id = cursor.fetchone()[0]
-        conn.commit()
+        cursor.connection.commit()
+
+        # create starting graph for user in gremlin
+        insert_sql = """
+        INSERT INTO Nodes (topic, learning_status, masteries, blurb, public_name)
+        VALUES (%s, %s, %s, %s, %s) RETURNING id;
+        """
+        cursor.execute(insert_sql, (Topics.HUMAN_INTUITION, [], json.dumps({}), "", "You"))
+        base_id = cursor.fetchone()[0]
 
-    except Exception as e:
-        conn.rollback()
-        postgreSQL_pool.putconn(conn)
-        postgreSQL_pool.closeall()
-        raise e
-    
-    # create starting graph for user in gremlin
-    insert_sql = """
-    INSERT INTO Nodes (topic, learning_status, masteries, blurb, public_name)
-    VALUES (%s, %s, %s, %s, %s) RETURNING id;
-    """
-    cursor.execute(insert_sql, (Topics.HUMAN_INTUITION, [], json.dumps({}), "", "You"))
-    base_id = cursor.fetchone()[0]
-    conn.commit()
     snc = graph_client.submit(f"g.addV('start_node').property('user_id','{user_id}').property('table_id','{base_id}').property('lesson_id','-1').property('status','complete').property('pk','pk')")
     snc.all().result()
 
@@ -238,7 +224,4 @@ def create_new_user(req_json: dict) -> int:
     #     cc = graph_client.submit(f"g.V().hasLabel('start_node').has('user_id', '{user_id}').addE('base').to(g.V().hasLabel('{subject_l}_base_node').has('user_id', '{user_id}'))")
     #     cc.all().result()
 
-    postgreSQL_pool.putconn(conn)
-    postgreSQL_pool.closeall()
-
     return user_id
\ No newline at end of file